@@ -69,6 +69,7 @@ def makeZip():
     projectDir =  os.path.dirname(__file__)
     sourceDir = os.path.join(projectDir, "src")
     sourceFile = os.path.join(sourceDir, 'PM_heatWeight.py')
+    extraSourceFiles = [os.path.join(sourceDir, 'PM_heatWeightCmd.py')]
     packagesDir = os.path.join(projectDir, "packages")
     contentsDir = os.path.join(packagesDir, "contents")
     scriptsDir = os.path.join(contentsDir, "scripts")
@@ -98,6 +99,9 @@ def makeZip():
     
     createReadmeFile(readmeFilePath, pmhLocals['__doc__'])
     shutil.copyfile(scriptFileFromPath, scriptFileToPath)
+    for extraFile in extraSourceFiles:
+        shutil.copyfile(extraFile,
+                        os.path.join(scriptsDir, os.path.basename(extraFile)))
     for bin in pinnocchioBinaries:
         binSrcPth = os.path.join(pinocchioBinariesDir, bin)
         if os.path.isfile(binSrcPth):
@@ -44,6 +44,7 @@ SETUP:
 ------
 Step 1: Copy the script files,
       /scripts/PM_heatWeight.py
+      /scripts/PM_heatWeightCmd.py
       /scripts/AttachWeightsWin.exe  (if you're using windows)
       /scripts/AttachWeightsMac      (if you're using intel-based OSX)
       /scripts/AttachWeightsLinux    (if you're using linux)
@@ -129,6 +130,64 @@ correct formatting of that email address...)
 
 Changelog:
 
+v0.7 - New parameters:
+    workers=1
+        Number of meshes to run the Pinocchio binary on at once; all meshes
+        are exported first, solved in parallel, then imported
+    timeout=None
+        Number of seconds after which to give up on a mesh's solve
+    progressCallback=None
+        Function called with each line of output from the Pinocchio binary
+    Solves may now be cancelled from the progress window, or with cancelSolves()
+    If numpy is available, weights are read, checked, and mapped from bones to
+        joints in bulk
+    Weights are now kept in a compact sparse form (SparseWeights) while
+        importing, rather than for every joint of every vertex
+    Skin weights are set from whole arrays at once, using the python api 2.0 if
+        available, rather than one element at a time
+    New PM_heatWeightCmd.py plugin, which allows weights to be set quickly AND
+        undoably; if it is installed, you will no longer be asked which mode
+        to use
+    Without the plugin, the undoable mode now sets the weights with batched
+        setAttrs, rather than a skinPercent per vertex
+    The skeleton is only exported once per call, rather than once per mesh,
+        and not at all if it is unchanged since the last export
+    The skeleton's joints and positions are now found using the api, in a
+        single pass
+    Joints are matched up with the skin's influences using a dict, rather than
+        comparing every joint with every influence, and missing influences
+        are all added at once
+    Meshes are read and written to obj directly with the api, rather than by
+        duplicating / closing / triangulating them in the scene, and using
+        objExport
+    tempStaging='disk'
+        Set to 'ram' or 'fifo' to keep the temporary files off the disk
+    cacheDir=None, cacheSize=None
+        Directory (and size limit) for a cache of solve results, so unchanged
+        meshes need not be solved again
+    New heatWeightSweep function, which solves for several stiffness values at
+        once, and returns the results so any of them may be applied without
+        solving again
+    engine='pinocchio'
+        Set to 'python' to solve the weights in-process with numpy / scipy,
+        rather than with the Pinocchio binary
+    The python engine keeps what it can between solves of the same mesh, so
+        re-weighting after moving a joint, or with the same settings, is
+        much faster
+    incremental=False
+        Set to True to only rewrite the weights of the vertices which have
+        changed since the mesh was last weighted
+    Mesh components may be selected, to only set the weights of those
+        vertices
+    feather=0
+        Number of rings of vertices over which the weights of selected
+        components are blended into the existing weights
+    proxyRatio=None
+        Set to solve each mesh on a decimated proxy, with about this
+        fraction of its vertices, and transfer the weights back
+    merge=False, mergeThreshold=20000
+        Set merge to solve all the meshes with up to mergeThreshold vertices
+        together, in a single solve
 v0.6.6 - Bugfix for undoable mode not working (thanks eduardo grana!)
     Fixed vanishing mesh issue in fast mode
         (on an error, will now restore original weights)
@@ -162,7 +221,7 @@ class Version(object):
     def __str__(self):
         return ".".join([str(x) for x in self.nums])
 
-version = Version(0,6,6)
+version = Version(0,7)
 __doc__ = __doc__ % str(version)
 
 import subprocess
@@ -171,12 +230,45 @@ import os
 import os.path
 import platform
 import traceback
+import threading
+import Queue
+import time
+import array
+import itertools
+import hashlib
+import errno
+import struct
+import zlib
+import sys
+import multiprocessing
+import re
+import json
+import optparse
 
 import maya.cmds as cmds #@UnresolvedImport
 import maya.mel as mel
 import maya.OpenMaya as api
 import maya.OpenMayaAnim as apiAnim
 
+try:
+    import maya.api.OpenMaya as api2
+    import maya.api.OpenMayaAnim as apiAnim2
+except ImportError:
+    api2 = None
+    apiAnim2 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import scipy.sparse
+    import scipy.sparse.linalg
+    import scipy.spatial
+except ImportError:
+    scipy = None
+
 DEBUG = False
 
 _PINOCCHIO_DIR = os.path.join(os.path.dirname(__file__))
@@ -194,6 +286,8 @@ class PinocchioError(Exception): pass
 class BinaryNotFoundError(PinocchioError): pass
 class InfluenceNotFoundError(PinocchioError): pass
 class CannotOverwriteError(PinocchioError): pass
+class SolveCancelledError(PinocchioError): pass
+class SolveTimeoutError(PinocchioError): pass
 
 # In HELP file, there's a Hip|L_Hip and a Hip|transform1|L_Hip ...
 # should we pick up the joint that has a transform inserted?
@@ -204,25 +298,109 @@ def pinocchioSkeletonExport(skeletonRoot, skelFile=None,
 
     Returns (skelFile, skelList), where skelList is the list returned
     by  makePinocchioSkeletonList.
+    
+    The skeleton is only re-read from the scene / the file re-written if the
+    joints have changed since the last export; see getPinocchioSkeleton.
     """
     if skelFile is None:
         skelFile = browseForFile(m=1, actionName='Export')
-    skelList = makePinocchioSkeletonList(skeletonRoot,
-                                directDescendentsOnly=directDescendentsOnly)
-    fileObj = open(skelFile, mode="w")
-    try:
-        for jointIndex, (joint, parentIndex) in enumerate(skelList):
-            jointCoords = getTranslation(joint, space='world')
+    skeleton = getPinocchioSkeleton(skeletonRoot,
+                                    directDescendentsOnly=directDescendentsOnly)
+    skeleton.writeFile(skelFile)
+    return (skelFile, skeleton.skelList)
+
+class PinocchioSkeleton(object):
+    """
+    The joints of a skeleton, as exported for pinocchio.
+    
+    skelList is the list returned by makePinocchioSkeletonList, positions the
+    world-space position of each of those joints, and text the contents of the
+    pinocchio skeleton file. digest is a hash of the joints and their
+    positions, so two PinocchioSkeletons with the same digest produce the same
+    skeleton file.
+    """
+    def __init__(self, skelList, positions):
+        self.skelList = skelList
+        self.positions = positions
+        lines = []
+        for jointIndex, ((joint, parentIndex), jointCoords) in \
+                enumerate(zip(skelList, positions)):
             if DEBUG:
                 print joint, ":", jointIndex, jointCoords, parentIndex
-            fileObj.write("%d %.5f %.5f %.5f %d\r\n" % (jointIndex,
-                                                        jointCoords[0],
-                                                        jointCoords[1],
-                                                        jointCoords[2],
-                                                        parentIndex))
-    finally:
-        fileObj.close()
-    return (skelFile, skelList)
+            lines.append("%d %.5f %.5f %.5f %d\r\n" % (jointIndex,
+                                                       jointCoords[0],
+                                                       jointCoords[1],
+                                                       jointCoords[2],
+                                                       parentIndex))
+        self.lines = lines
+        self.text = ''.join(lines)
+        digest = hashlib.md5(self.text)
+        for joint, parentIndex in skelList:
+            digest.update(joint)
+        self.digest = digest.hexdigest()
+    
+    def writeFile(self, skelFile):
+        """
+        Writes the pinocchio skeleton file, unless it already exists with the
+        same contents.
+        """
+        if os.path.isfile(skelFile):
+            fileObj = open(skelFile)
+            try:
+                if fileObj.read() == self.text:
+                    return
+            finally:
+                fileObj.close()
+        fileObj = open(skelFile, mode="w")
+        try:
+            fileObj.write(self.text)
+        finally:
+            fileObj.close()
+
+    def changedBones(self, other):
+        """
+        Returns the sorted indices of the pinocchio bones which have moved
+        between the other (earlier) skeleton and this one - ie, those whose
+        start or end joint is at a different position in the skeleton file.
+        
+        If the skeletons don't have the same joints, with the same parents,
+        None is returned.
+        """
+        if [(dagPathKey(joint), parentIndex)
+                for joint, parentIndex in self.skelList] != \
+           [(dagPathKey(joint), parentIndex)
+                for joint, parentIndex in other.skelList]:
+            return None
+        movedJoints = set(jointIndex for jointIndex, (line, otherLine)
+                          in enumerate(zip(self.lines, other.lines))
+                          if line != otherLine)
+        # Bone i ends at joint i + 1 - the root joint has no bone
+        return [jointIndex - 1 for jointIndex, (joint, parentIndex)
+                in enumerate(self.skelList)
+                if jointIndex > 0 and (jointIndex in movedJoints or
+                                       parentIndex in movedJoints)]
+
+# PinocchioSkeletons from the last getPinocchioSkeleton for each
+# (rootJoint, directDescendentsOnly)
+_skeletonCache = {}
+
+def getPinocchioSkeleton(rootJoint, directDescendentsOnly=False):
+    """
+    Returns a PinocchioSkeleton for the given root joint.
+    
+    If the joints and their world positions are unchanged since the last call
+    for the same root, the same PinocchioSkeleton object is returned, so its
+    file contents need not be made again.
+    """
+    skelList, positions = makePinocchioSkeletonListAndPositions(rootJoint,
+                                directDescendentsOnly=directDescendentsOnly)
+    skeleton = PinocchioSkeleton(skelList, positions)
+    key = (cmds.ls(rootJoint, long=True)[0], directDescendentsOnly)
+    cached = _skeletonCache.get(key)
+    if cached is not None and cached.digest == skeleton.digest:
+        return cached
+    _skeletonCache[key] = skeleton
+    return skeleton
 
 def pinocchioSkeletonImport(skelFile):
     name = os.path.splitext(os.path.basename(skelFile))[0]
@@ -273,17 +451,33 @@ def pinocchioSkeletonImport(skelFile):
 
     return rootNode
 
-def pinocchioObjExport(mesh, objFilePath):
+def pinocchioObjExport(mesh, objFilePath, proxyRatio=None):
+    """
+    Exports the mesh, triangulated and with any open borders closed, to an obj
+    file that pinocchio can read.
+    
+    The geometry is read straight from the api, so nothing in the scene is
+    touched; if this version of maya's api can't triangulate meshes, the
+    mesh is duplicated, closed, triangulated and exported with objExport.
+    
+    If proxyRatio is given, a decimated proxy of the mesh, with about that
+    fraction of its vertices, is exported instead; see makeProxyMesh.
+    """
+    if not hasattr(api.MFnMesh, 'getTriangles'):
+        if proxyRatio is not None:
+            raise PinocchioError("proxy meshes require MFnMesh.getTriangles")
+        return _pinocchioObjExportCmds(mesh, objFilePath)
+    pinocchioMesh = getPinocchioMesh(mesh)
+    if proxyRatio is not None:
+        pinocchioMesh = makeProxyMesh(pinocchioMesh, proxyRatio)[0]
+    pinocchioMesh.writeObj(objFilePath)
+    return objFilePath
+
+def _pinocchioObjExportCmds(mesh, objFilePath):
     loadObjPlugin()
     savedSel = cmds.ls(sl=1)
     try:
-        if not isATypeOf(mesh, 'geometryShape'):
-            subShape = getShape(mesh)
-            if subShape:
-                mesh = subShape
-        if not isATypeOf(mesh, 'geometryShape'):
-            raise TypeError('cannot find a geometry shape for %s' % mesh)
-            
+        mesh = _getGeometryShape(mesh)
         meshDup = addShape(mesh)
         cmds.polyCloseBorder(meshDup, ch=0)
         cmds.polyTriangulate(meshDup, ch=0)
@@ -296,391 +490,3215 @@ def pinocchioObjExport(mesh, objFilePath):
         cmds.select(savedSel)
     return objFilePath
 
+def _getGeometryShape(mesh):
+    if not isATypeOf(mesh, 'geometryShape'):
+        subShape = getShape(mesh)
+        if subShape:
+            mesh = subShape
+    if not isATypeOf(mesh, 'geometryShape'):
+        raise TypeError('cannot find a geometry shape for %s' % mesh)
+    return mesh
+
+class PinocchioMesh(object):
+    """
+    The triangulated geometry of a mesh, with any open borders closed, as
+    exported for pinocchio.
+    
+    points is a flat list of the world space x, y, z coordinates of each
+    vertex (in ui units, to match the skeleton), and triangles a flat list of
+    the three vertex indices of each triangle.  The vertices are in the same
+    order as the maya mesh's, so the weights pinocchio outputs line up with
+    them.
+    """
+    def __init__(self, points, triangles):
+        self.points = points
+        self.triangles = triangles
+        self._digest = None
+    
+    @property
+    def numVertices(self):
+        return len(self.points) // 3
+    
+    @property
+    def numTriangles(self):
+        return len(self.triangles) // 3
+    
+    def objChunks(self, chunkSize=65536):
+        """
+        Yields the contents of an obj file for the mesh, as strings of up to
+        chunkSize lines each.
+        """
+        for chunk in _formatLines('v %.6f %.6f %.6f\n', self.points, 3,
+                                  chunkSize):
+            yield chunk
+        # obj vertex indices are 1-based
+        for chunk in _formatLines('f %d %d %d\n',
+                                  [x + 1 for x in self.triangles], 3,
+                                  chunkSize):
+            yield chunk
+    
+    def writeObj(self, objFilePath):
+        fileObj = open(objFilePath, 'w', _WRITE_BUFFER_SIZE)
+        try:
+            for chunk in self.objChunks():
+                fileObj.write(chunk)
+        finally:
+            fileObj.close()
+    
+    @classmethod
+    def concatenate(cls, meshes):
+        """
+        Makes a single PinocchioMesh from the vertices and triangles of each of
+        the given PinocchioMeshes, in order
+        """
+        points = []
+        triangles = []
+        for mesh in meshes:
+            offset = len(points) // 3
+            points.extend(mesh.points)
+            triangles.extend([x + offset for x in mesh.triangles])
+        return cls(points, triangles)
+    
+    def digest(self):
+        """
+        Returns a hash of the obj file contents for the mesh
+        """
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for chunk in self.objChunks():
+                digest.update(chunk)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# Default for the number of vertices above which meshes aren't merged
+_MERGE_THRESHOLD = 20000
+
+def _formatLines(lineFormat, values, valuesPerLine, linesPerChunk):
+    """
+    Yields strings of up to linesPerChunk lines, each formatted from the next
+    valuesPerLine values with lineFormat - formatting a whole chunk with a
+    single % operation.
+    """
+    valuesPerChunk = valuesPerLine * linesPerChunk
+    for start in xrange(0, len(values), valuesPerChunk):
+        chunk = tuple(values[start:start + valuesPerChunk])
+        yield (lineFormat * (len(chunk) // valuesPerLine)) % chunk
+
+def getPinocchioMesh(mesh):
+    """
+    Returns a PinocchioMesh for the given mesh (or its transform), reading
+    its points and triangles with the api.
+    """
+    mesh = _getGeometryShape(mesh)
+    if api2 is not None:
+        sel = api2.MSelectionList()
+        sel.add(mesh)
+        fnMesh = api2.MFnMesh(sel.getDagPath(0))
+        apiPoints = fnMesh.getPoints(api2.MSpace.kWorld)
+        triangleCounts, apiTriangles = fnMesh.getTriangles()
+        triangles = list(apiTriangles)
+    else:
+        fnMesh = api.MFnMesh(toMDagPath(mesh))
+        apiPoints = api.MPointArray()
+        fnMesh.getPoints(apiPoints, api.MSpace.kWorld)
+        triangleCounts = api.MIntArray()
+        apiTriangles = api.MIntArray()
+        fnMesh.getTriangles(triangleCounts, apiTriangles)
+        triangles = [apiTriangles[i] for i in xrange(apiTriangles.length())]
+        apiPoints = [apiPoints[i] for i in xrange(apiPoints.length())]
+    # The api gives us internal units, but the skeleton is in ui units
+    scale = api.MDistance.internalToUI(1.0)
+    points = []
+    for point in apiPoints:
+        points.extend((point.x * scale, point.y * scale, point.z * scale))
+    triangles.extend(closeBorderTriangles(triangles))
+    return PinocchioMesh(points, triangles)
+
+def closeBorderTriangles(triangles):
+    """
+    Given a flat list of triangle vertex indices, returns a flat list of the
+    vertex indices of new triangles that close any open borders (the
+    equivalent of polyCloseBorder + polyTriangulate). Each border is closed
+    with a fan of triangles, so no vertices are added.
+    """
+    # A border edge is one used by only one triangle - ie, where the
+    # triangle's directed edge a->b has no matching b->a
+    edges = set()
+    for i in xrange(0, len(triangles), 3):
+        a, b, c = triangles[i:i + 3]
+        edges.update(((a, b), (b, c), (c, a)))
+    # The face closing the border has the border edges reversed; map each
+    # vertex to the next one(s) around it
+    nextVerts = {}
+    for a, b in edges:
+        if (b, a) not in edges:
+            nextVerts.setdefault(b, []).append(a)
+    
+    newTriangles = []
+    while nextVerts:
+        start = iter(nextVerts).next()
+        loop = [start]
+        vert = start
+        while True:
+            nexts = nextVerts.get(vert)
+            if not nexts:
+                break
+            nextVert = nexts.pop()
+            if not nexts:
+                del nextVerts[vert]
+            if nextVert == start:
+                break
+            loop.append(nextVert)
+            vert = nextVert
+        for i in xrange(1, len(loop) - 1):
+            newTriangles.extend((loop[0], loop[i], loop[i + 1]))
+    return newTriangles
 
 def makePinocchioSkeletonList(rootJoint,
                               directDescendentsOnly=False):
     """
     Given a joint, returns info used for the pinocchio skeleton export.
     
-    Each item in the list is a tuple ([x,y,z], parentIndex), where
+    Each item in the list is a tuple (joint, parentIndex), where
     parentIndex is an index into the list.
     """
+    return makePinocchioSkeletonListAndPositions(rootJoint,
+                            directDescendentsOnly=directDescendentsOnly)[0]
+
+def makePinocchioSkeletonListAndPositions(rootJoint,
+                                          directDescendentsOnly=False):
+    """
+    Returns (skelList, positions), where skelList is as returned by
+    makePinocchioSkeletonList, and positions is the world space [x,y,z]
+    translation of each joint in it (as given by getTranslation).
+    
+    Both are gathered in a single pass over the dag using the api, rather
+    than querying each node / joint with maya.cmds.
+    """
     # Note - it seems that, in current incarnation (2010/02/28),
     # attachweights requires the skelList's order be such that
-    # parents must be declared before children...
+    # parents must be declared before children... a depth first traversal
+    # visits parents before their children, so gives us that for free
     if not isATypeOf(rootJoint, 'joint'):
         raise TypeError("rootJoint arg %r was not a joint" % rootJoint)
-    return _makePinocchioSkeletonList([], rootJoint, -1,
-                                                 directDescendentsOnly=directDescendentsOnly)
-
-def _makePinocchioSkeletonList(skelList, newJoint, parentIndex,
-                                        directDescendentsOnly=False):
-    if isATypeOf(newJoint, 'joint'):
-        nextParentIndex = len(skelList)
-        skelList.append((newJoint, parentIndex))
-    else:
-        nextParentIndex = parentIndex
-    kwargs = {'children':True, 'noIntermediate':True, 'fullPath':True}
-    if directDescendentsOnly:
-        kwargs['type'] = 'joint'
-    directChildren = listForNone(cmds.listRelatives(newJoint, **kwargs))
-    for child in directChildren:
-        _makePinocchioSkeletonList(skelList, child, nextParentIndex)
-    return skelList
+    skelList = []
+    positions = []
+    # The index of the nearest joint at or above the node at each depth - ie,
+    # the parentIndex for children of a node at that depth
+    depthJointIndices = []
+    dagIt = api.MItDag(api.MItDag.kDepthFirst, api.MFn.kInvalid)
+    dagIt.reset(toMObject(rootJoint), api.MItDag.kDepthFirst, api.MFn.kInvalid)
+    dagPath = api.MDagPath()
+    while not dagIt.isDone():
+        depth = dagIt.depth()
+        del depthJointIndices[depth:]
+        if depth == 0:
+            parentIndex = -1
+        else:
+            parentIndex = depthJointIndices[depth - 1]
+        dagIt.getPath(dagPath)
+        isJoint = dagPath.hasFn(api.MFn.kJoint)
+        if api.MFnDagNode(dagPath).isIntermediateObject() or \
+                (directDescendentsOnly and depth == 1 and not isJoint):
+            # Only the root's direct children are restricted to joints when
+            # directDescendentsOnly is set
+            dagIt.prune()
+            dagIt.next()
+            continue
+        if isJoint:
+            depthJointIndices.append(len(skelList))
+            if depth == 0:
+                # Keep the root joint's name as it was given
+                skelList.append((rootJoint, parentIndex))
+            else:
+                skelList.append((dagPath.fullPathName(), parentIndex))
+            translation = api.MFnTransform(dagPath).getTranslation(api.MSpace.kWorld)
+            positions.append([api.MDistance.internalToUI(translation[i])
+                              for i in xrange(3)])
+        else:
+            depthJointIndices.append(parentIndex)
+        dagIt.next()
+    return skelList, positions
+
+_SETATTR_BATCH_SIZE = 2000
 
 def pinocchioWeightsImport(mesh, skin, skelList, weightFile=None,
-                           undoable=False):
+                           undoable=False, usePlugin=True,
+                           undoableMethod='setAttr', weights=None,
+                           vertices=None, blend=None):
+    """
+    Reads the weights output by the Pinocchio binary, and sets them as the
+    skin weights of the mesh.
+    
+    If undoable is True, and usePlugin is True and the PM_heatWeightCmd plugin
+    can be loaded, the weights are set with the plugin's undoable command
+    (fast, and undoable).  If the plugin is not used, undoableMethod controls
+    how they are set: 'setAttr' sets the nonzero weights directly on the
+    skin's weightList plugs, in large batches of mel; 'skinPercent' sets
+    them with one skinPercent per vertex (much slower).
+    If undoable is False, they are set using the api directly, which is fast,
+    but flushes the undo queue.
+    
+    If weights (a SparseWeights of the per-bone weights, as returned by
+    readPinocchioSparseWeights) is given, it is used instead of reading
+    weightFile.
+    
+    If vertices (a sorted list of vertex indices) is given, only the weights of
+    those vertices are set, from the matching rows of the weights; the weights
+    of all other vertices are left as they are.  If blend is also given - a
+    factor from 0 to 1 for each of the vertices - each vertex is instead set
+    to that blend of its new weights and its existing ones (1 giving just the
+    new weights), so the new weights may be feathered into the old.
+    """
     #Ensure that all influences in the skelList are influences for the skin
-    allInfluences = influenceObjects(skin)
+    allInfluences = _influenceIndexMap(influenceObjects(skin))
     pinocInfluences = [joint for joint, parent in skelList]
-    for joint in pinocInfluences:
-        if not nodeIn(joint, allInfluences):
-            cmds.skinCluster(skin, edit=1, addInfluence=joint)
+    missingInfluences = [joint for joint in pinocInfluences
+                         if dagPathKey(joint) not in allInfluences]
+    if missingInfluences:
+        cmds.skinCluster(skin, edit=1, addInfluence=missingInfluences)
 
-    if weightFile is None:
-        weightFile = browseForFile(m=0, actionName='Import')
-    vertBoneWeights = readPinocchioWeights(weightFile)
+    if weights is not None:
+        vertBoneWeights = weights
+    else:
+        if weightFile is None:
+            weightFile = browseForFile(m=0, actionName='Import')
+        vertBoneWeights = readPinocchioSparseWeights(weightFile)
+    if vertices is not None:
+        vertices = [int(x) for x in vertices]
+        if not vertices:
+            return
+        vertBoneWeights = vertBoneWeights.takeRows(vertices)
     numVertices = len(vertBoneWeights)
-    numBones = len(vertBoneWeights[0])
+    numBones = vertBoneWeights.numColumns
     numJoints = len(skelList)
-    numWeights = numVertices * numJoints
     if DEBUG:
         print "numVertices:", numVertices
         print "numBones:", numBones
     assert numBones == numJoints - 1, \
            "numBones (%d) != numJoints (%d) - 1" % (numBones, numJoints)
 
-    # Pinocchio sets weights per-bone... maya weights per joint.
-    # Need to decide whether to assign the bone weight to the 'start' joint
-    #   of the bone, or the 'end' joint
-    boneIndexToJointIndex = [0] * numBones
-    vertJointWeights = [[0] * numJoints for i in xrange(numVertices)]
-
-    assignBoneToEndJoint = False
-    if assignBoneToEndJoint:
-        for jointIndex in xrange(1, numJoints):
-            boneIndexToJointIndex[jointIndex - 1] = jointIndex
-    else:
-        for jointIndex in xrange(1, numJoints):
-            parentIndex = skelList[jointIndex][1]
-            boneIndexToJointIndex[jointIndex - 1] = parentIndex
+    vertJointWeights = boneToJointWeights(vertBoneWeights, skelList)
     
-    for vertIndex, boneWeights in enumerate(vertBoneWeights):
-        assert abs(sum(boneWeights) - 1) < 0.1, \
-               "Output for vert %d not normalized - total was: %.03f" % \
-               (vertIndex, sum(boneWeights))
-        for boneIndex, boneValue in enumerate(boneWeights):
-            # multiple bones can correspond to a single joint -
-            # make sure to add the various bones values together!
-            jointIndex = boneIndexToJointIndex[boneIndex] 
-            vertJointWeights[vertIndex][jointIndex] += boneValue
+    if blend is not None:
+        # Blend with the existing weights of all the skin's influences (so the
+        # blended weights still sum to 1), and then set them all
+        influences = influenceObjects(skin)
+        vertJointWeights = vertJointWeights.remapColumns(
+            _getInfluenceIndices(skin, pinocInfluences, influences),
+            len(influences)).blendRows(
+                _getSparseSkinWeights(skin, mesh, numVertices,
+                                      vertices=vertices), blend)
+        pinocInfluences = influences
 
     if DEBUG:
         print "vertJointWeights:"
-        for i, jointWeights in enumerate(vertJointWeights):
+        for i, (jointIndices, jointValues) in enumerate(vertJointWeights):
             if i < 20:
-                print jointWeights
+                print zip(jointIndices, jointValues)
             else:
                 print "..."
                 break
     
+    if undoable and usePlugin and loadWeightsPlugin():
+        # The plugin command sets the weights with the api, but keeps the old
+        # weights so it can be undone; it sets every influence, so there's no
+        # need to zero the weights first
+        influences = influenceObjects(skin)
+        apiJointIndices = _getInfluenceIndices(skin, pinocInfluences, influences)
+        key = _storePendingWeights(skin, mesh,
+                                   vertJointWeights.remapColumns(apiJointIndices,
+                                                                 len(influences)),
+                                   vertices)
+        try:
+            getattr(cmds, _WEIGHTS_PLUGIN_COMMAND)(key)
+        finally:
+            _pendingWeights.pop(key, None)
+        return
+    
     if not undoable:
         # If we're using the non-undoable api method, there's a lot of setup
         # we have to do first; want to do this before zeroing weights,
         # in case there's an error 
-        apiWeights = api.MDoubleArray(numWeights, 0)
-        for vertIndex, jointWeights in enumerate(vertJointWeights):
-            for jointIndex, jointValue in enumerate(jointWeights):
-                apiWeights.set(jointValue, vertIndex * numJoints + jointIndex)
-        apiJointIndices = api.MIntArray(numJoints, 0)
         if DEBUG:
             for jointIndex, (joint, parentIndex) in enumerate(skelList):
                 print jointIndex, (joint, parentIndex)
         influences = influenceObjects(skin)
-        for apiIndex, joint in enumerate(influences):
-            influenceIndex = getNodeIndex(joint, pinocInfluences)
-            if influenceIndex is None:
-                raise InfluenceNotFoundError("%r not found in influences for skin %r: %r" %
-                                             (joint, skin, pinocInfluences))
-            apiJointIndices.set(apiIndex, influenceIndex)
+        apiJointIndices = _getInfluenceIndices(skin, pinocInfluences, influences)
         if DEBUG:
-            print "apiJointIndices:",
-            pyJointIndices = []
-            for i in xrange(apiJointIndices.length()):
-                pyJointIndices.append(apiJointIndices[i])
-            print pyJointIndices
-        apiComponents = api.MFnSingleIndexedComponent().create(api.MFn.kMeshVertComponent)
-        apiVertices = api.MIntArray(numVertices, 0)
-        for i in xrange(numVertices):
-            apiVertices.set(i, i)
-        api.MFnSingleIndexedComponent(apiComponents).addElements(apiVertices) 
-        mfnSkin = apiAnim.MFnSkinCluster(toMObject(skin))
-        meshDag = toMDagPath(mesh)
+            print "apiJointIndices:", apiJointIndices
         # Save the weights, so that if there's an error later, we
         # can still restore the weights
-        savedWeights = api.MDoubleArray(numWeights, 0)
-        numInfluencesPtr = api.MScriptUtil()
-        numInfluencesPtr.createFromInt(0) 
-        mfnSkin.getWeights(meshDag, apiComponents, savedWeights,
-                           numInfluencesPtr.asUintPtr())
+        savedWeights = _getSparseSkinWeights(skin, mesh, numVertices,
+                                             vertices=vertices)
         
     # Zero all weights (so if there's influences not among those we're
     # importing, they will have zero influence)
-    cmds.skinPercent(skin, mesh, pruneWeights=100, normalize=False)
+    if vertices is None:
+        cmds.skinPercent(skin, mesh, pruneWeights=100, normalize=False)
+    else:
+        cmds.skinPercent(skin, _vertexNames(mesh, vertices), pruneWeights=100,
+                         normalize=False)
 
     if not undoable:
         # Use the api methods to set skin weights - MUCH faster than using
         # mel skinPercent, but api doesn't have built-in undo support, so
         # flush the undo queue
-        zeroedWeights = api.MDoubleArray()
         undoState = cmds.undoInfo(q=1, state=1)
         cmds.undoInfo(state=False)
         try:
-            try:
-                mfnSkin.setWeights(meshDag,
-                                   apiComponents,
-                                   apiJointIndices,
-                                   apiWeights,
-                                   False,
-                                   zeroedWeights)
-                print "successfully set weights!"
-            except Exception:
-                # There was a problem, restore the saved weights!
-                influenceIndices = api.MIntArray(len(influences), 0)
-                for i in xrange(len(influences)):
-                    influenceIndices.set(i,i)
-                mfnSkin.setWeights(meshDag,
-                                   apiComponents,
-                                   influenceIndices,
-                                   savedWeights,
-                                   False,
-                                   zeroedWeights)
-                api.MGlobal.displayError("Encountered error setting new weights - original weights restored")
-                raise
+            try:
+                _setSparseSkinWeights(skin, mesh, vertJointWeights,
+                                      apiJointIndices, vertices=vertices)
+                print "successfully set weights!"
+            except Exception:
+                # There was a problem, restore the saved weights!
+                _setSparseSkinWeights(skin, mesh, savedWeights,
+                                      range(len(influences)), allColumns=True,
+                                      vertices=vertices)
+                api.MGlobal.displayError("Encountered error setting new weights - original weights restored")
+                raise
+        finally:
+            cmds.flushUndo()
+            cmds.undoInfo(state=undoState)
+    elif undoableMethod == 'setAttr':
+        # Write only the nonzero weights straight to the skin's weightList,
+        # many setAttrs per mel call - much faster than skinPercent, and
+        # still undoable
+        influences = influenceObjects(skin)
+        logicalIndices = influenceLogicalIndices(skin)
+        jointPlugIndices = [logicalIndices[x] for x in
+                            _getInfluenceIndices(skin, pinocInfluences, influences)]
+        _setWeightsWithSetAttr(skin, vertJointWeights, jointPlugIndices,
+                               vertices=vertices)
+    else:
+        # Use mel skinPercent - much slower, but undoable
+        cmds.progressWindow(title="Setting new weights...", isInterruptable=True,
+                            max=numVertices)
+        try:
+            lastUpdateTime = cmds.timerX()
+            updateInterval = .5
+            for rowIndex, (jointIndices, jointWeights) in enumerate(vertJointWeights):
+                if vertices is None:
+                    vertIndex = rowIndex
+                else:
+                    vertIndex = vertices[rowIndex]
+                jointValues = {}
+                if cmds.progressWindow( query=True, isCancelled=True ) :
+                    break
+                #print "weighting vert:", vertIndex
+                for jointIndex, jointValue in zip(jointIndices, jointWeights):
+                    if jointValue > 0:
+                        jointValues[pinocInfluences[jointIndex]] = float(jointValue)
+        
+                if cmds.timerX(startTime=lastUpdateTime) > updateInterval:
+                    cmds.progressWindow(edit=True,
+                                        progress=rowIndex,
+                                        status="Setting Vert: (%i of %i)" % (rowIndex, numVertices))
+                    lastUpdateTime = cmds.timerX()
+    
+                cmds.skinPercent(skin, mesh + ".vtx[%d]" % vertIndex, normalize=False,
+                                 transformValue=jointValues.items())
+        finally:
+            cmds.progressWindow(endProgress=True)    
+
+def _setWeightsWithSetAttr(skin, weights, plugIndices,
+                           batchSize=_SETATTR_BATCH_SIZE, vertices=None):
+    """
+    Undoably sets the skin weights from a SparseWeights, whose columns
+    correspond to the given weightList plug (logical influence) indices.
+    If vertices is given, row i of the weights is for vertex vertices[i];
+    otherwise, for vertex i.
+    
+    Only the nonzero weights are set, with a single multi-index setAttr for
+    each run of consecutive plug indices, and batchSize setAttrs evaluated in
+    each call to mel.
+    """
+    numVertices = len(weights)
+    cmds.progressWindow(title="Setting new weights...", isInterruptable=True,
+                        max=numVertices)
+    chunkOpened = _openUndoChunk()
+    try:
+        commands = []
+        for rowIndex, (columns, values) in enumerate(weights):
+            if vertices is None:
+                vertIndex = rowIndex
+            else:
+                vertIndex = vertices[rowIndex]
+            plugWeights = sorted((plugIndices[column], float(value))
+                                 for column, value in zip(columns, values)
+                                 if value > 0)
+            runStart = 0
+            while runStart < len(plugWeights):
+                runEnd = runStart + 1
+                while (runEnd < len(plugWeights) and
+                       plugWeights[runEnd][0] == plugWeights[runEnd - 1][0] + 1):
+                    runEnd += 1
+                commands.append('setAttr %s.wl[%d].w[%d:%d] %s' %
+                                (skin, vertIndex, plugWeights[runStart][0],
+                                 plugWeights[runEnd - 1][0],
+                                 ' '.join(['%.8g' % value for plugIndex, value
+                                           in plugWeights[runStart:runEnd]])))
+                runStart = runEnd
+            
+            if len(commands) >= batchSize or rowIndex == numVertices - 1:
+                if commands:
+                    mel.eval(';'.join(commands))
+                    commands = []
+                if cmds.progressWindow( query=True, isCancelled=True ) :
+                    break
+                cmds.progressWindow(edit=True,
+                                    progress=rowIndex,
+                                    status="Setting Vert: (%i of %i)" % (rowIndex, numVertices))
+    finally:
+        if chunkOpened:
+            cmds.undoInfo(closeChunk=True)
+        cmds.progressWindow(endProgress=True)
+
+def _openUndoChunk():
+    """
+    Opens an undo chunk, so the following commands are undone in a single
+    step; returns False if this version of maya doesn't support undo chunks.
+    """
+    try:
+        cmds.undoInfo(openChunk=True)
+    except TypeError:
+        return False
+    return True
+
+_WEIGHT_BLOCK_SIZE = 4096
+
+_WEIGHTS_PLUGIN = 'PM_heatWeightCmd'
+_WEIGHTS_PLUGIN_COMMAND = 'pmHeatWeightSetWeights'
+
+def loadWeightsPlugin():
+    """
+    Loads the PM_heatWeightCmd plugin, which provides an undoable command for
+    setting the weights with the api.
+    
+    Returns True if the plugin is loaded, or False if it could not be found /
+    loaded.
+    """
+    if cmds.pluginInfo(_WEIGHTS_PLUGIN, q=1, loaded=True):
+        return True
+    # Look for the plugin alongside this file first, then on the plugin path
+    pluginPath = os.path.join(_PINOCCHIO_DIR, _WEIGHTS_PLUGIN + '.py')
+    if not os.path.isfile(pluginPath):
+        pluginPath = _WEIGHTS_PLUGIN + '.py'
+    try:
+        cmds.loadPlugin(pluginPath, quiet=True)
+    except RuntimeError:
+        if DEBUG:
+            traceback.print_exc()
+        return False
+    return bool(cmds.pluginInfo(_WEIGHTS_PLUGIN, q=1, loaded=True))
+
+# Weights waiting to be set by the plugin command, as
+# (skin, mesh, influenceWeights, vertices), keyed by the string passed to the
+# command
+_pendingWeights = {}
+_pendingWeightsCount = itertools.count()
+
+def _storePendingWeights(skin, mesh, influenceWeights, vertices=None):
+    key = 'weights%d' % _pendingWeightsCount.next()
+    _pendingWeights[key] = (skin, mesh, influenceWeights, vertices)
+    return key
+
+def _popPendingWeights(key):
+    """
+    Used by the plugin command to retrieve the
+    (skin, mesh, influenceWeights, vertices) it was called for;
+    influenceWeights is a SparseWeights with one column for each influence of
+    the skin, and one row for each of the vertices - or for every vertex of
+    the mesh, if vertices is None.
+    """
+    try:
+        return _pendingWeights.pop(key)
+    except KeyError:
+        raise PinocchioError("no pending weights found for %r" % key)
+
+def _influenceIndexMap(influences):
+    """
+    Given a list of influences, as returned by influenceObjects, returns a
+    dict mapping the dagPathKey of each to its index in the list.
+    """
+    return dict((dagPathKey(influence), i)
+                for i, influence in enumerate(influences))
+
+def _getInfluenceIndices(skin, joints, influences):
+    """
+    Returns a list of the api influence index (ie, the index in influences)
+    for each of the given joints.
+    """
+    influenceIndexMap = _influenceIndexMap(influences)
+    influenceIndices = []
+    for joint in joints:
+        influenceIndex = influenceIndexMap.get(dagPathKey(joint))
+        if influenceIndex is None:
+            raise InfluenceNotFoundError("%r not found in influences for skin %r: %r" %
+                                         (joint, skin, influences))
+        influenceIndices.append(influenceIndex)
+    return influenceIndices
+
+def _setSparseSkinWeights(skin, mesh, weights, influenceIndices,
+                          allColumns=False, vertices=None):
+    """
+    Sets the skin weights of the mesh from a SparseWeights, whose columns
+    correspond to the given api influence indices.
+    
+    So that a dense copy of all the weights is never made, they are set a
+    block of vertices at a time, and only for the influences actually used by
+    that block (unless allColumns is True) - weights for any other influences
+    are left as they are.
+    
+    If vertices (a sorted list of vertex indices) is given, row i of the
+    weights is set on vertex vertices[i]; otherwise, on vertex i.
+    """
+    apiModule, mfnSkin, meshDag = _getSkinFnAndPath(skin, mesh)
+    numVertices = len(weights)
+    for start in xrange(0, numVertices, _WEIGHT_BLOCK_SIZE):
+        end = min(start + _WEIGHT_BLOCK_SIZE, numVertices)
+        if allColumns:
+            columns = range(weights.numColumns)
+        else:
+            columns = weights.columnsUsed(start, end)
+            if not len(columns):
+                continue
+        blockInfluences = _toIntArray([influenceIndices[x] for x in columns],
+                                      apiModule)
+        blockWeights = _toDoubleArray(weights.denseBlock(start, end, columns),
+                                      apiModule)
+        mfnSkin.setWeights(meshDag,
+                           _vertexComponent(_blockVertices(vertices, start, end),
+                                            apiModule),
+                           blockInfluences, blockWeights, False)
+
+def _getSparseSkinWeights(skin, mesh, numVertices, vertices=None):
+    """
+    Returns the current skin weights of the mesh, for all influences, as a
+    SparseWeights, reading them a block of vertices at a time.
+    
+    If vertices (a sorted list of vertex indices) is given, the weights of
+    just those vertices are returned, one row for each, and numVertices is
+    ignored.
+    """
+    if vertices is not None:
+        numVertices = len(vertices)
+    apiModule, mfnSkin, meshDag = _getSkinFnAndPath(skin, mesh)
+    if apiModule is api:
+        numInfluencesUtil = api.MScriptUtil()
+        numInfluencesUtil.createFromInt(0)
+        numInfluencesPtr = numInfluencesUtil.asUintPtr()
+    parts = []
+    for start in xrange(0, numVertices, _WEIGHT_BLOCK_SIZE):
+        end = min(start + _WEIGHT_BLOCK_SIZE, numVertices)
+        components = _vertexComponent(_blockVertices(vertices, start, end),
+                                      apiModule)
+        if apiModule is api:
+            blockWeights = api.MDoubleArray()
+            mfnSkin.getWeights(meshDag, components, blockWeights,
+                               numInfluencesPtr)
+            numInfluences = api.MScriptUtil.getUint(numInfluencesPtr)
+            values = [blockWeights[i] for i in xrange(blockWeights.length())]
+        else:
+            blockWeights, numInfluences = mfnSkin.getWeights(meshDag,
+                                                             components)
+            values = list(blockWeights)
+        rows = [values[i:i + numInfluences]
+                for i in xrange(0, len(values), numInfluences)]
+        # Keep every nonzero weight, so they can be restored exactly
+        parts.append(SparseWeights.fromDense(rows, epsilon=0))
+    return SparseWeights.concatenate(parts)
+
+def _getSkinFnAndPath(skin, mesh):
+    """
+    Returns (apiModule, mfnSkin, meshDag), using the python api 2.0 if it is
+    available (as it can build arrays from sequences in a single call), or
+    the old api otherwise.
+    """
+    if api2 is not None:
+        sel = api2.MSelectionList()
+        sel.add(skin)
+        sel.add(mesh)
+        return (api2, apiAnim2.MFnSkinCluster(sel.getDependNode(0)),
+                sel.getDagPath(1))
+    return api, apiAnim.MFnSkinCluster(toMObject(skin)), toMDagPath(mesh)
+
+def _vertexComponent(vertices, apiModule=api):
+    """
+    Returns a mesh vertex component MObject for the given vertex indices, for
+    either the old api or the python api 2.0
+    """
+    apiComponents = apiModule.MFnSingleIndexedComponent().create(
+        apiModule.MFn.kMeshVertComponent)
+    apiModule.MFnSingleIndexedComponent(apiComponents).addElements(
+        _toIntArray(vertices, apiModule))
+    return apiComponents
+
+def _blockVertices(vertices, start, end):
+    """
+    Returns the vertex indices for rows start to end of some weights, where
+    row i is for vertex vertices[i], or for vertex i if vertices is None
+    """
+    if vertices is None:
+        return xrange(start, end)
+    return vertices[start:end]
+
+def _vertexNames(mesh, vertices):
+    """
+    Returns a list of mesh.vtx[...] component names covering the given sorted
+    vertex indices, with one name for each run of consecutive indices.
+    """
+    names = []
+    runStart = 0
+    while runStart < len(vertices):
+        runEnd = runStart + 1
+        while (runEnd < len(vertices) and
+               vertices[runEnd] == vertices[runEnd - 1] + 1):
+            runEnd += 1
+        names.append('%s.vtx[%d:%d]' % (mesh, vertices[runStart],
+                                        vertices[runEnd - 1]))
+        runStart = runEnd
+    return names
+
+def _toIntArray(values, apiModule=api):
+    """
+    Makes an MIntArray from a sequence in a single call, rather than setting
+    each element one at a time, for either the old api or the python api 2.0
+    """
+    values = _toList(values)
+    if apiModule is not api:
+        return apiModule.MIntArray(values)
+    if not values:
+        return api.MIntArray()
+    util = api.MScriptUtil()
+    util.createFromList(values, len(values))
+    return api.MIntArray(util.asIntPtr(), len(values))
+
+def _toDoubleArray(values, apiModule=api):
+    """
+    Makes an MDoubleArray from a sequence in a single call, rather than setting
+    each element one at a time, for either the old api or the python api 2.0
+    """
+    values = _toList(values)
+    if apiModule is not api:
+        return apiModule.MDoubleArray(values)
+    if not values:
+        return api.MDoubleArray()
+    util = api.MScriptUtil()
+    util.createFromList(values, len(values))
+    return api.MDoubleArray(util.asDoublePtr(), len(values))
+
+def _toList(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        # Much faster than iterating over the numpy scalars
+        return values.tolist()
+    elif isinstance(values, list):
+        return values
+    return list(values)
+
+def boneToJointWeights(vertBoneWeights, skelList, assignBoneToEndJoint=False):
+    """
+    Converts the per-bone weights read by readPinocchioWeights into per-joint
+    weights, with one column for each joint in skelList.
+    
+    Pinocchio sets weights per-bone... maya weights per joint, so we need to
+    decide whether to assign the bone weight to the 'start' joint of the bone
+    (the default), or the 'end' joint. Since multiple bones can correspond to
+    a single joint, the values of the various bones are added together.
+    
+    Returns a SparseWeights if given a SparseWeights, a
+    (numVertices x numJoints) array if given an array, or a list of lists
+    otherwise.
+    """
+    numJoints = len(skelList)
+    boneJoints = boneIndexToJointIndex(skelList,
+                                       assignBoneToEndJoint=assignBoneToEndJoint)
+    if isinstance(vertBoneWeights, SparseWeights):
+        return vertBoneWeights.remapColumns(boneJoints, numJoints)
+    if numpy is not None and isinstance(vertBoneWeights, numpy.ndarray):
+        boneToJoint = numpy.zeros((len(boneJoints), numJoints),
+                                  dtype=vertBoneWeights.dtype)
+        boneToJoint[numpy.arange(len(boneJoints)), boneJoints] = 1
+        return numpy.dot(vertBoneWeights, boneToJoint)
+    
+    vertJointWeights = []
+    for boneWeights in vertBoneWeights:
+        jointWeights = [0] * numJoints
+        for boneIndex, boneValue in enumerate(boneWeights):
+            jointWeights[boneJoints[boneIndex]] += boneValue
+        vertJointWeights.append(jointWeights)
+    return vertJointWeights
+
+def boneIndexToJointIndex(skelList, assignBoneToEndJoint=False):
+    """
+    Returns a list mapping each pinocchio bone index to the index of the joint
+    in skelList its weights are assigned to (see boneToJointWeights).
+    """
+    # Bone i ends at joint i + 1 - the root joint has no bone
+    if assignBoneToEndJoint:
+        return range(1, len(skelList))
+    else:
+        return [parentIndex for joint, parentIndex in skelList[1:]]
+
+def useUndoableMethod():
+    message = \
+    '''This script works in two modes:
+    slow, but undoable
+    faster, but clears undo
+    
+Which do you prefer?'''
+    undoable = 'Undoable'
+    faster = 'Faster'
+    button = cmds.confirmDialog(title='Confirm', message=message,
+                                button=[undoable,faster],
+                                defaultButton=undoable,
+                                cancelButton=undoable,
+                                dismissString=undoable)
+    if button == faster:
+        return False
+    else:
+        return True
+
+def readPinocchioWeights(weightFile, dtype='float64'):
+    """
+    Reads the per-vertex bone weights output by the Pinocchio binary.
+    
+    If numpy is available, the weights are parsed in bulk into a single
+    (numVertices x numBones) array of the given dtype; otherwise, a list of
+    lists of floats is returned.
+    """
+    if numpy is None:
+        weightList = []
+        fileObj = open(weightFile)
+        try:
+            for line in fileObj:
+                weightList.append([float(x) for x in line.strip().split(' ')])
+        finally:
+            fileObj.close()
+        return weightList
+    
+    fileObj = open(weightFile)
+    try:
+        firstLine = fileObj.readline()
+        numBones = len(firstLine.split())
+        if not numBones:
+            raise PinocchioError("no weights found in %s" % weightFile)
+        fileObj.seek(0)
+        weights = numpy.fromfile(fileObj, dtype=dtype, sep=' ')
+    finally:
+        fileObj.close()
+    if weights.size % numBones:
+        raise PinocchioError("%s contained %d weights, which is not a multiple"
+                             " of the number of bones (%d)"
+                             % (weightFile, weights.size, numBones))
+    return weights.reshape((-1, numBones))
+
+def checkPinocchioWeights(vertBoneWeights, numBones, tolerance=0.1,
+                          firstVert=0):
+    """
+    Raises a PinocchioError if the weights read by readPinocchioWeights are not
+    for the given number of bones, or a vertex's weights do not sum to 1 (to
+    within the given tolerance).
+    
+    firstVert is added to the vertex indices reported in errors, for when
+    checking only part of the weights.
+    """
+    if numpy is not None and isinstance(vertBoneWeights, numpy.ndarray):
+        if vertBoneWeights.ndim != 2 or vertBoneWeights.shape[1] != numBones:
+            raise PinocchioError("expected weights for %d bones - got array"
+                                 " of shape %r"
+                                 % (numBones, vertBoneWeights.shape))
+        totals = vertBoneWeights.sum(axis=1)
+        badVerts = numpy.flatnonzero(abs(totals - 1) >= tolerance)
+        if len(badVerts):
+            raise PinocchioError("Output for vert %d not normalized - total"
+                                 " was: %.03f" % (firstVert + badVerts[0],
+                                                  totals[badVerts[0]]))
+        return
+    
+    for vertIndex, boneWeights in enumerate(vertBoneWeights):
+        if len(boneWeights) != numBones:
+            raise PinocchioError("expected weights for %d bones - vert %d had"
+                                 " %d" % (numBones, firstVert + vertIndex,
+                                          len(boneWeights)))
+        if abs(sum(boneWeights) - 1) >= tolerance:
+            raise PinocchioError("Output for vert %d not normalized - total"
+                                 " was: %.03f" % (firstVert + vertIndex,
+                                                  sum(boneWeights)))
+
+def readPinocchioSparseWeights(weightFile, epsilon=None, tolerance=0.1,
+                               chunkSize=65536):
+    """
+    Reads the per-vertex bone weights output by the Pinocchio binary into a
+    SparseWeights, dropping any weights at or below epsilon (WEIGHT_EPSILON by
+    default), and checking each vertex's weights with checkPinocchioWeights.
+    
+    The file is parsed chunkSize lines at a time, so the dense weights for the
+    whole mesh are never held in memory at once.
+    """
+    if epsilon is None:
+        epsilon = WEIGHT_EPSILON
+    parts = []
+    numBones = None
+    numVertices = 0
+    fileObj = open(weightFile)
+    try:
+        while True:
+            lines = [x for x in itertools.islice(fileObj, chunkSize) if x.strip()]
+            if not lines:
+                break
+            if numBones is None:
+                numBones = len(lines[0].split())
+            if numpy is not None:
+                chunk = numpy.fromstring(''.join(lines), sep=' ')
+                if chunk.size != len(lines) * numBones:
+                    raise PinocchioError("expected weights for %d bones in %s,"
+                                         " near vert %d"
+                                         % (numBones, weightFile, numVertices))
+                chunk = chunk.reshape((len(lines), numBones))
+            else:
+                chunk = [[float(x) for x in line.split()] for line in lines]
+            checkPinocchioWeights(chunk, numBones, tolerance=tolerance,
+                                  firstVert=numVertices)
+            parts.append(SparseWeights.fromDense(chunk, epsilon=epsilon))
+            numVertices += len(lines)
+    finally:
+        fileObj.close()
+    if not parts:
+        raise PinocchioError("no weights found in %s" % weightFile)
+    return SparseWeights.concatenate(parts)
+
+WEIGHT_EPSILON = 1e-6
+
+_SERIALIZED_MAGIC = 'PMSW'
+_SERIALIZED_HEADER = '<4sIII'
+
+class SparseWeights(object):
+    """
+    Per-vertex weights, stored in compressed sparse row form: the nonzero
+    weights for row (vertex) i are values[offsets[i]:offsets[i + 1]], and the
+    columns (bones or joints) they belong to are the corresponding entries of
+    indices.
+    
+    The arrays are numpy arrays if numpy is available, or array.array objects
+    otherwise.
+    """
+    def __init__(self, offsets, indices, values, numColumns):
+        self.offsets = offsets
+        self.indices = indices
+        self.values = values
+        self.numColumns = numColumns
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __iter__(self):
+        for rowIndex in xrange(len(self)):
+            yield self.row(rowIndex)
+    
+    def row(self, rowIndex):
+        """Returns (indices, values) for the nonzero weights of the given row"""
+        start = self.offsets[rowIndex]
+        end = self.offsets[rowIndex + 1]
+        return self.indices[start:end], self.values[start:end]
+    
+    def columnsUsed(self, start=0, end=None):
+        """
+        Returns the sorted columns with nonzero weights in rows start to end
+        """
+        if end is None:
+            end = len(self)
+        indices = self.indices[self.offsets[start]:self.offsets[end]]
+        if numpy is not None:
+            return numpy.unique(indices)
+        return sorted(set(indices))
+    
+    def denseBlock(self, start, end, columns):
+        """
+        Returns the weights of rows start to end as a flat, row-major sequence
+        of (end - start) * len(columns) values, with a value for each of the
+        given sorted columns; columns must include all the columnsUsed by those
+        rows.
+        """
+        numRows = end - start
+        first = self.offsets[start]
+        last = self.offsets[end]
+        if numpy is not None:
+            rows = numpy.repeat(numpy.arange(numRows),
+                                numpy.diff(self.offsets[start:end + 1]))
+            block = numpy.zeros((numRows, len(columns)), dtype=self.values.dtype)
+            block[rows, numpy.searchsorted(columns, self.indices[first:last])] = \
+                self.values[first:last]
+            return block.ravel()
+        
+        numColumns = len(columns)
+        columnPositions = dict((column, i) for i, column in enumerate(columns))
+        block = [0.0] * (numRows * numColumns)
+        for rowIndex in xrange(start, end):
+            rowStart = (rowIndex - start) * numColumns
+            indices, values = self.row(rowIndex)
+            for column, value in zip(indices, values):
+                block[rowStart + columnPositions[column]] = value
+        return block
+    
+    def remapColumns(self, columnMap, numColumns):
+        """
+        Returns a new SparseWeights with numColumns columns, where the weights
+        for column i are moved to column columnMap[i]; weights moved to the
+        same column are added together.
+        """
+        if numpy is not None:
+            numRows = len(self)
+            rows = numpy.repeat(numpy.arange(numRows), numpy.diff(self.offsets))
+            keys = rows * numColumns + numpy.asarray(columnMap)[self.indices]
+            keys, inverse = numpy.unique(keys, return_inverse=True)
+            values = numpy.bincount(inverse, weights=self.values)
+            offsets = numpy.zeros(numRows + 1, dtype=self.offsets.dtype)
+            numpy.cumsum(numpy.bincount(keys // numColumns, minlength=numRows),
+                         out=offsets[1:])
+            return SparseWeights(offsets,
+                                 (keys % numColumns).astype(self.indices.dtype),
+                                 values.astype(self.values.dtype), numColumns)
+        
+        offsets = array.array('l', [0])
+        indices = array.array('l')
+        values = array.array('d')
+        for rowIndices, rowValues in self:
+            rowWeights = {}
+            for column, value in zip(rowIndices, rowValues):
+                newColumn = columnMap[column]
+                rowWeights[newColumn] = rowWeights.get(newColumn, 0) + value
+            for column in sorted(rowWeights):
+                indices.append(column)
+                values.append(rowWeights[column])
+            offsets.append(len(indices))
+        return SparseWeights(offsets, indices, values, numColumns)
+    
+    def changedRows(self, other, epsilon=WEIGHT_EPSILON):
+        """
+        Returns the sorted indices of the rows whose weight for any column
+        differs from that of the same row of other (which must have the same
+        number of rows) by more than epsilon.
+        """
+        if len(other) != len(self):
+            raise ValueError("cannot compare weights with %d rows to %d rows"
+                             % (len(self), len(other)))
+        if numpy is not None:
+            numRows = len(self)
+            numColumns = max(self.numColumns, other.numColumns)
+            keys = []
+            for weights in (self, other):
+                rows = numpy.repeat(numpy.arange(numRows),
+                                    numpy.diff(weights.offsets))
+                keys.append(rows * numColumns + weights.indices)
+            keys, inverse = numpy.unique(numpy.concatenate(keys),
+                                         return_inverse=True)
+            differences = numpy.bincount(inverse, weights=numpy.concatenate(
+                                                [self.values, -other.values]))
+            return numpy.unique(keys[abs(differences) > epsilon] // numColumns)
+        
+        changed = []
+        for rowIndex in xrange(len(self)):
+            differences = {}
+            for weights, sign in ((self, 1), (other, -1)):
+                for column, value in zip(*weights.row(rowIndex)):
+                    differences[column] = differences.get(column, 0) + sign * value
+            for difference in differences.itervalues():
+                if abs(difference) > epsilon:
+                    changed.append(rowIndex)
+                    break
+        return changed
+    
+    def takeRows(self, rows):
+        """
+        Returns a new SparseWeights holding just the given rows, in the order
+        given
+        """
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+            counts = numpy.diff(self.offsets)[rows]
+            offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+            numpy.cumsum(counts, out=offsets[1:])
+            positions = (numpy.repeat(self.offsets[:-1][rows] - offsets[:-1],
+                                      counts) +
+                         numpy.arange(offsets[-1]))
+            return SparseWeights(offsets, self.indices[positions],
+                                 self.values[positions], self.numColumns)
+        
+        offsets = array.array('l', [0])
+        indices = array.array('l')
+        values = array.array('d')
+        for rowIndex in rows:
+            rowIndices, rowValues = self.row(rowIndex)
+            indices.extend(rowIndices)
+            values.extend(rowValues)
+            offsets.append(len(indices))
+        return SparseWeights(offsets, indices, values, self.numColumns)
+    
+    def blendRows(self, other, factors):
+        """
+        Returns a new SparseWeights, whose row i is factors[i] times row i of
+        this one, plus (1 - factors[i]) times row i of other (which must have
+        the same number of rows and columns)
+        """
+        if len(other) != len(self):
+            raise ValueError("cannot blend weights with %d rows and %d rows"
+                             % (len(self), len(other)))
+        if numpy is not None:
+            numRows = len(self)
+            numColumns = self.numColumns
+            factors = numpy.asarray(factors, dtype=numpy.float64)
+            keys = []
+            values = []
+            for weights, weightFactors in ((self, factors),
+                                           (other, 1.0 - factors)):
+                rows = numpy.repeat(numpy.arange(numRows),
+                                    numpy.diff(weights.offsets))
+                keys.append(rows * numColumns + weights.indices)
+                values.append(weights.values * weightFactors[rows])
+            keys, inverse = numpy.unique(numpy.concatenate(keys),
+                                         return_inverse=True)
+            values = numpy.bincount(inverse, weights=numpy.concatenate(values))
+            keep = values != 0
+            keys = keys[keep]
+            offsets = numpy.zeros(numRows + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(keys // numColumns, minlength=numRows),
+                         out=offsets[1:])
+            return SparseWeights(offsets,
+                                 (keys % numColumns).astype(self.indices.dtype),
+                                 values[keep], numColumns)
+        
+        offsets = array.array('l', [0])
+        indices = array.array('l')
+        values = array.array('d')
+        for rowIndex, factor in enumerate(factors):
+            rowWeights = {}
+            for weights, weightFactor in ((self, factor), (other, 1.0 - factor)):
+                for column, value in zip(*weights.row(rowIndex)):
+                    rowWeights[column] = (rowWeights.get(column, 0) +
+                                          weightFactor * value)
+            for column in sorted(rowWeights):
+                if rowWeights[column] != 0:
+                    indices.append(column)
+                    values.append(rowWeights[column])
+            offsets.append(len(indices))
+        return SparseWeights(offsets, indices, values, self.numColumns)
+    
+    def replaceRows(self, rows, other):
+        """
+        Returns a new SparseWeights, with the given rows taken from other (which
+        must have the same number of rows), and all the rest from this one
+        """
+        replaced = set(rows)
+        parts = []
+        runStart = 0
+        numRows = len(self)
+        while runStart < numRows:
+            fromOther = runStart in replaced
+            runEnd = runStart + 1
+            while runEnd < numRows and (runEnd in replaced) == fromOther:
+                runEnd += 1
+            source = other if fromOther else self
+            parts.append(source.takeRows(xrange(runStart, runEnd)))
+            runStart = runEnd
+        if not parts:
+            return self.takeRows([])
+        return SparseWeights.concatenate(parts)
+    
+    @classmethod
+    def fromDense(cls, rows, epsilon=WEIGHT_EPSILON):
+        """
+        Makes a SparseWeights from a (numRows x numColumns) array or list of
+        lists, dropping any weights whose magnitude is at or below epsilon.
+        """
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.float64)
+            if rows.ndim != 2:
+                rows = rows.reshape((len(rows), -1))
+            keep = abs(rows) > epsilon
+            offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+            numpy.cumsum(keep.sum(axis=1), out=offsets[1:])
+            indices = numpy.nonzero(keep)[1].astype(numpy.int32)
+            return cls(offsets, indices, rows[keep], rows.shape[1])
+        
+        offsets = array.array('l', [0])
+        indices = array.array('l')
+        values = array.array('d')
+        numColumns = 0
+        for row in rows:
+            numColumns = len(row)
+            for column, value in enumerate(row):
+                if abs(value) > epsilon:
+                    indices.append(column)
+                    values.append(value)
+            offsets.append(len(indices))
+        return cls(offsets, indices, values, numColumns)
+    
+    def serialize(self):
+        """
+        Returns the weights as a compact, portable string of bytes, which can
+        be turned back into a SparseWeights with deserialize.
+        
+        The indices are stored as 32-bit ints and the values as 32-bit floats
+        (both little-endian), zlib compressed.
+        """
+        parts = [struct.pack(_SERIALIZED_HEADER, _SERIALIZED_MAGIC, len(self),
+                             self.numColumns, len(self.values))]
+        for values, typecode, dtype in ((self.offsets, 'i', '<i4'),
+                                        (self.indices, 'i', '<i4'),
+                                        (self.values, 'f', '<f4')):
+            if numpy is not None:
+                parts.append(numpy.asarray(values).astype(dtype).tostring())
+            else:
+                packed = array.array(typecode, values)
+                if sys.byteorder == 'big':
+                    packed.byteswap()
+                parts.append(packed.tostring())
+        return zlib.compress(''.join(parts))
+    
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Makes a SparseWeights from a string returned by serialize.
+        """
+        data = zlib.decompress(data)
+        magic, numRows, numColumns, numValues = \
+            struct.unpack_from(_SERIALIZED_HEADER, data)
+        if magic != _SERIALIZED_MAGIC:
+            raise PinocchioError("data is not serialized SparseWeights")
+        pos = struct.calcsize(_SERIALIZED_HEADER)
+        arrays = []
+        for size, typecode, dtype, newTypecode, newDtype in (
+                (numRows + 1, 'i', '<i4', 'l', 'int64'),
+                (numValues, 'i', '<i4', 'l', 'int32'),
+                (numValues, 'f', '<f4', 'd', 'float64')):
+            chunk = data[pos:pos + 4 * size]
+            pos += 4 * size
+            if numpy is not None:
+                arrays.append(numpy.fromstring(chunk, dtype=dtype).astype(newDtype))
+            else:
+                packed = array.array(typecode)
+                packed.fromstring(chunk)
+                if sys.byteorder == 'big':
+                    packed.byteswap()
+                arrays.append(array.array(newTypecode, packed))
+        offsets, indices, values = arrays
+        return cls(offsets, indices, values, numColumns)
+    
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Makes a single SparseWeights from the rows of each of the given
+        SparseWeights, in order
+        """
+        numColumns = parts[0].numColumns
+        if numpy is not None:
+            offsets = [numpy.zeros(1, dtype=numpy.int64)]
+            shift = 0
+            for part in parts:
+                offsets.append(part.offsets[1:] + shift)
+                shift += part.offsets[-1]
+            return cls(numpy.concatenate(offsets),
+                       numpy.concatenate([x.indices for x in parts]),
+                       numpy.concatenate([x.values for x in parts]),
+                       numColumns)
+        
+        offsets = array.array('l', [0])
+        indices = array.array('l')
+        values = array.array('d')
+        for part in parts:
+            shift = len(indices)
+            offsets.extend(x + shift for x in part.offsets[1:])
+            indices.extend(part.indices)
+            values.extend(part.values)
+        return cls(offsets, indices, values, numColumns)
+
+def runPinocchioBin(meshFile, weightFile, fit=False, stiffness=1.0, skelOut="skeleton.out",
+                    weightOut="weights.out", progressCallback=None, timeout=None,
+                    cancelEvent=None):
+    """
+    Runs the Pinocchio binary, and waits for it to finish.
+    
+    progressCallback, if given, is called as progressCallback(streamName, line)
+    for each line the binary writes, where streamName is 'stdout' or 'stderr';
+    otherwise, the binary's output goes to maya's stdout, as usual.  Note that
+    it is called from whichever thread runPinocchioBin was called from.
+    
+    If timeout is given, and the binary has not finished after that many
+    seconds, it is killed and a SolveTimeoutError is raised.
+    
+    If cancelEvent (a threading.Event) is set while waiting, the binary is
+    killed and a SolveCancelledError is raised; if not given, the event set by
+    cancelSolves() is used.
+    """
+    if cancelEvent is None:
+        cancelEvent = _solvesCancelled
+    # Change current directory to ensure we know where attachment.out will be
+    if not os.path.isfile(_PINOCCHIO_BIN):
+        raise BinaryNotFoundError("Could not find the binary: %s" %
+                                  _PINOCCHIO_BIN)
+    if cancelEvent.isSet():
+        raise SolveCancelledError("solve cancelled before starting")
+    os.chdir(_PINOCCHIO_DIR)
+    exeAndArgs = [_PINOCCHIO_BIN, meshFile, '-skel', weightFile,
+                  '-stiffness', str(stiffness),
+                  '-skelOut', skelOut,
+                  '-weightOut', weightOut]
+    if fit:
+        exeAndArgs.append('-fit')
+    if DEBUG:
+        print "Calling command line binary:"
+        print 'subprocess.Popen(%r)' % exeAndArgs
+        print ' '.join(exeAndArgs)
+    
+    output = Queue.Queue()
+    readers = []
+    if progressCallback is None:
+        process = subprocess.Popen(exeAndArgs)
+    else:
+        process = subprocess.Popen(exeAndArgs, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        for streamName in ('stdout', 'stderr'):
+            reader = threading.Thread(target=_readPipeLines,
+                                      args=(getattr(process, streamName),
+                                            streamName, output))
+            reader.setDaemon(True)
+            reader.start()
+            readers.append(reader)
+    
+    startTime = time.time()
+    try:
+        while True:
+            # Waiting on the queue doubles as our poll interval
+            try:
+                streamName, line = output.get(timeout=_POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+            else:
+                progressCallback(streamName, line)
+                continue
+            if process.poll() is not None and \
+                    not [x for x in readers if x.isAlive()] and output.empty():
+                break
+            if cancelEvent.isSet():
+                raise SolveCancelledError("solve cancelled")
+            if timeout is not None and time.time() - startTime > timeout:
+                raise SolveTimeoutError("solve did not finish within %s seconds"
+                                        % timeout)
+    finally:
+        if process.poll() is None:
+            _killProcess(process)
+    if process.returncode != 0:
+        raise PinocchioError("return code: %d" % process.returncode)
+
+def runPinocchioBinWithFifos(pinocchioMesh, objFifo, skelFile, weightFifo,
+                             **kwargs):
+    """
+    Runs the Pinocchio binary like runPinocchioBin, where objFifo and
+    weightFifo are named pipes (see os.mkfifo) rather than files: the
+    PinocchioMesh is streamed into objFifo as the binary reads it, and the
+    weights are parsed from weightFifo as the binary writes them, so neither
+    ever touches the disk.
+    
+    Returns the weights, as read by readPinocchioSparseWeights.
+    """
+    # fcntl isn't available on windows - but then, neither are fifos
+    import fcntl
+    
+    finished = threading.Event()
+    results = {}
+    
+    def writeObj():
+        # Opening a fifo for writing blocks until there is a reader, which
+        # will never happen if the binary fails early - so poll instead
+        fd = None
+        while fd is None:
+            try:
+                fd = os.open(objFifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, e:
+                if e.errno != errno.ENXIO or finished.isSet():
+                    raise
+                finished.wait(_POLL_INTERVAL)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        fileObj = os.fdopen(fd, 'w', _WRITE_BUFFER_SIZE)
+        try:
+            for chunk in pinocchioMesh.objChunks():
+                fileObj.write(chunk)
+        finally:
+            fileObj.close()
+    
+    def readWeights():
+        results['weights'] = readPinocchioSparseWeights(weightFifo)
+    
+    threads = []
+    for name, func in (('writeObj', writeObj), ('readWeights', readWeights)):
+        thread = threading.Thread(target=_catchErrors(func, results, name))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    try:
+        runPinocchioBin(objFifo, skelFile, weightOut=weightFifo, **kwargs)
+    finally:
+        finished.set()
+        # If the binary never opened the weight file, the reader is stuck
+        # waiting for a writer - open it ourselves, to give it an eof
+        while threads[1].isAlive():
+            try:
+                os.close(os.open(weightFifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            threads[1].join(_POLL_INTERVAL)
+        threads[0].join()
+    for name in ('writeObj', 'readWeights'):
+        if name + 'Error' in results:
+            raise PinocchioError("error in %s: %s" % (name, results[name + 'Error']))
+    return results['weights']
+
+def _makeFifos(*paths):
+    """
+    Makes a fifo at each of the given paths, replacing any existing files.
+    
+    Returns False if the fifos could not be made (ie, the filesystem does not
+    support them).
+    """
+    made = []
+    try:
+        for path in paths:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.mkfifo(path)
+            made.append(path)
+    except OSError:
+        # Don't leave any fifos behind for regular files to be written to
+        for path in made:
+            os.remove(path)
+        return False
+    return True
+
+def _catchErrors(func, results, name):
+    """
+    Wraps func, so that any exception it raises is stored in results, under
+    name + 'Error'
+    """
+    def wrapped():
+        try:
+            func()
+        except Exception, e:
+            results[name + 'Error'] = _formatException(e)
+    return wrapped
+
+def cancelSolves():
+    """
+    Kills any Pinocchio binaries currently being run by runPinocchioBin, and
+    prevents any more from starting, until the next call to heatWeight.
+    """
+    _solvesCancelled.set()
+
+_solvesCancelled = threading.Event()
+_POLL_INTERVAL = .1
+# Where to put temp files when staging them in ram
+_RAM_DIR = '/dev/shm'
+
+def _readPipeLines(pipe, streamName, output):
+    try:
+        for line in iter(pipe.readline, ''):
+            output.put((streamName, line.rstrip('\r\n')))
+    finally:
+        pipe.close()
+
+def _killProcess(process):
+    try:
+        process.kill()
+    except OSError:
+        # It may have finished in the meantime
+        pass
+    process.wait()
+
+def heatWeight(*args, **kwargs):
+    """
+    heatWeight(*rootAndMeshes, **kwargs)
+    
+    The non-keyword args should consist of exactly one skeleton root, and
+    at least one mesh you wish to weight to that skeleton. If no args are
+    given, the current selection is used.
+    
+    Instead of a whole mesh, poly components (vertices, edges or faces) may be
+    given, in which case only the weights of those vertices are set; the
+    weights of the rest of the mesh are left as they are. (The whole mesh is
+    still solved, as the weights of any one part depend on all the rest.)
+    
+    Valid keyword args:
+    undoable=False
+        Specify whether to assign skin weights using an undoable method, or a
+        fast method that requires flushing the undo queue.  If the
+        PM_heatWeightCmd plugin is available, the undoable method is just as
+        fast, and is used by default; otherwise, the undoable method is much
+        slower, and you will be asked which to use if this isn't given.
+    stiffness=1.0
+        Specify how 'stiff' to make the binding to the skeleton. The higher
+        the value, the more tightly vertices will be bound to the joint
+        deemed 'closest', and the less weights will 'bleed'.
+        Note that if a joint is relatively 'far' from all bones, then modifying
+        this value still may not have much effect, as (in essence) the computer
+        is unsure WHICH bone the joint should be more stiffly bound to. This
+        situation can result when, for instance, you have a very round, fat
+        character.  In this case, the best idea is to either add bones which
+        are 'closer' to the problem area, or simply correct it with weight
+        painting afterward.  (This script is not meant to replace weight
+        painting, but merely to give you a better place to start from!)
+    tempOutputDir=None
+        Specify a directory where temporary files used by the Pinocchio binary
+        are stored
+    tempDelete=True
+        Whether or not to delete the temporary files used by the Pinocchio binary
+        when finished
+    tempOverwrite=True
+        Whether or not to overwrite any existing temporary files
+    directDescendentsOnly=False
+        heatWeight only weights joints; this controls whether there must be a
+        direct joint chain from the root to joints included in the skeleton, or
+        whether there can be intervening (non-joint) transforms.
+        ie, if this setting is False, a joint such as
+            myRoot|myTransform|otherJoint
+        would NOT be allowed; if it is True, it would be.
+    workers=1
+        The number of meshes to run the Pinocchio binary on at once. All the
+        meshes are exported first, then solved with up to this many binaries
+        running in parallel, and finally the weights are imported back one
+        mesh at a time. If 0 or None, one per cpu is used.
+    timeout=None
+        If given, the number of seconds to let the Pinocchio binary run on any
+        one mesh before giving up on it.  (Solves may also be cancelled from
+        the progress window, or by calling cancelSolves().)
+    progressCallback=None
+        If given, called as progressCallback(streamName, line) for each line
+        of output from the Pinocchio binary; see runPinocchioBin.  Note that
+        it may be called from threads other than the main one.
+    tempStaging='disk'
+        How the temporary files used by the Pinocchio binary are stored:
+            'disk' - in the normal temp directory
+            'ram'  - in a ram-backed directory (/dev/shm), if available
+            'fifo' - the mesh and weights are streamed to and from the binary
+                     through named pipes, as they are generated / read, and
+                     the remaining files are kept in ram; only available on
+                     systems with os.mkfifo, otherwise 'ram' is used
+        If tempOutputDir is given, the files are kept there regardless,
+        though 'fifo' will still use named pipes.
+    cacheDir=None
+        A directory in which to cache the results of solves, so that weighting
+        an unchanged mesh to an unchanged skeleton with the same settings
+        doesn't need to run the Pinocchio binary again.  The directory may be
+        shared by several users.  Defaults to the PM_HEATWEIGHT_CACHE_DIR
+        environment variable; if neither is set, no cache is used.
+    cacheSize=None
+        The maximum size of the cache, in megabytes; when it is exceeded, the
+        least recently used results are removed.  Defaults to the
+        PM_HEATWEIGHT_CACHE_SIZE environment variable, or 1024.
+    engine='pinocchio'
+        What solves the weights:
+            'pinocchio' - the Pinocchio binary
+            'python'    - solveHeatWeights, run in-process on the mesh data;
+                          requires numpy and scipy, and doesn't support fit.
+                          The results differ slightly from the binary's, as it
+                          judges which bones a vertex can 'see' exactly,
+                          rather than with Pinocchio's approximate distance
+                          field.  The timeout and progressCallback are not
+                          used, and a solve can only be cancelled before it
+                          starts.
+    incremental=False
+        If True, and a mesh was last weighted (by heatWeight, in this session)
+        to the same joints of this skeleton, with the same skinCluster, only
+        the vertices whose solved weights differ from those set then by more
+        than WEIGHT_EPSILON are set - so after moving a few joints, just the
+        affected vertices are rewritten.  The weights of all other vertices
+        are left as they are, including any painted since.  If the joints
+        were added, removed or re-parented, all the weights are set.
+    feather=0
+        When weighting components, the number of rings of vertices around
+        them over which the new weights are blended into the existing ones,
+        falling off linearly; if 0, there is no blending.
+    merge=False
+        If True, meshes with no more than mergeThreshold vertices are
+        combined and solved as a single mesh, and the weights then split back
+        out to each; for characters made of many small pieces, this saves
+        exporting, launching the Pinocchio binary, and setting up the
+        skeleton, for each one.  Note that the pieces are then treated as one
+        mesh when working out which bones each vertex can 'see', so one
+        piece can block another's view of a bone; and if the merged solve
+        fails, it fails for every merged mesh.
+    mergeThreshold=20000
+        The number of vertices above which a mesh is solved on its own, when
+        merging.
+    proxyRatio=None
+        If given (a number between 0 and 1), each mesh is solved on a
+        decimated proxy of it, with about that fraction of its vertices, and
+        the weights carried back to the full mesh's vertices by
+        interpolating them at the closest point on the proxy; see
+        makeProxyMesh and transferWeights.  Much faster, and uses much less
+        memory, for very dense meshes; how far the mesh is from the proxy,
+        and how much the weights vary over each proxy vertex, are printed as
+        a guide to the error this introduces.  Requires numpy and scipy.
+    """
+    return _heatWeightJobs(args, kwargs) is not None
+
+def _heatWeightJobs(args, kwargs):
+    """
+    Does the work of heatWeight, returning the list of _MeshJobs (with their
+    errors set for any meshes which failed), or None if the inputs were
+    invalid.
+    """
+    if not args:
+        args = listForNone(cmds.ls(sl=1))
+    
+    stiffness = kwargs.pop('stiffness', 1.0)
+    incremental = kwargs.pop('incremental', False)
+    feather = kwargs.pop('feather', 0)
+    session = _SolveSession(kwargs)
+    
+    rootJoint, meshes, meshVertices = _getRootAndMeshes(args)
+    if rootJoint is None:
+        return None
+    
+    undoable = _getUndoable(kwargs)
+    try:
+        jobs = session.solve(rootJoint, meshes, [stiffness])
+        if jobs is None:
+            return None
+        
+        # The import uses maya.cmds / the api, so must happen in the main thread
+        for job in jobs:
+            if job.error is None:
+                try:
+                    job.skin = _getOrMakeSkinCluster(job.mesh, rootJoint)
+                    _importJobWeights(job, rootJoint, session.skeleton,
+                                      undoable, incremental,
+                                      vertices=meshVertices[job.meshNum],
+                                      feather=feather)
+                except Exception, e:
+                    job.error = _formatException(e)
+            if job.error is not None:
+                api.MGlobal.displayWarning(
+                        "encountered exception while weighting mesh %s:\n%s" % (job.mesh, job.error))
+    finally:
+        session.cleanup()
+    return jobs
+
+# The bone weights last set on each mesh by heatWeight, as
+# (skin, skeleton, weights), keyed on the dagPathKeys of (mesh, rootJoint)
+_lastWeights = {}
+
+def _importJobWeights(job, rootJoint, skeleton, undoable, incremental,
+                      vertices=None, feather=0):
+    """
+    Sets the weights solved by a heatWeight job on its mesh's skin, and
+    records them, so that a later incremental heatWeight can tell which have
+    changed.
+    
+    If vertices is given, only the weights of those vertices are set,
+    feathered into the existing weights over 'feather' rings of vertices
+    around them.
+    
+    If incremental, and the weights last set on the mesh were for the same
+    skin and joints, only the vertices whose weights have changed since by
+    more than WEIGHT_EPSILON are set.
+    """
+    key = (dagPathKey(job.mesh), dagPathKey(rootJoint))
+    weights = job.weights
+    blend = None
+    if vertices is not None:
+        vertices, blend = _featherVertices(job.mesh, vertices, feather)
+    
+    last = _lastWeights.pop(key, None)
+    if last is not None:
+        lastSkin, lastSkeleton, lastWeights = last
+        changedBones = skeleton.changedBones(lastSkeleton)
+        if (changedBones is None or lastSkin != job.skin or
+                len(lastWeights) != len(weights)):
+            last = None
+    if incremental and last is not None:
+        changedRows = weights.changedRows(lastWeights)
+        if vertices is None:
+            vertices = changedRows
+            numVertices = len(weights)
+        else:
+            numVertices = len(vertices)
+            changedRows = set(changedRows)
+            keep = [i for i, vertex in enumerate(vertices)
+                    if vertex in changedRows]
+            vertices = [vertices[i] for i in keep]
+            if blend is not None:
+                blend = [blend[i] for i in keep]
+        print "%d bones moved - setting weights of %d of %d vertices" % \
+            (len(changedBones), len(vertices), numVertices)
+    
+    pinocchioWeightsImport(job.mesh, job.skin, job.skelList,
+                           weightFile=job.outWeightPath, undoable=undoable,
+                           weights=weights, vertices=vertices, blend=blend)
+    
+    if last is not None:
+        # The vertices not set (or only partly set) still have the weights
+        # they were last given
+        if blend is not None:
+            vertices = [vertex for vertex, factor in zip(vertices, blend)
+                        if factor >= 1]
+        if vertices is not None:
+            weights = lastWeights.replaceRows(vertices, weights)
+    elif vertices is not None:
+        # Only some of the weights are known
+        return
+    _lastWeights[key] = (job.skin, skeleton, weights)
+
+def heatWeightSweep(*args, **kwargs):
+    """
+    heatWeightSweep(*rootAndMeshes, stiffnessValues=[...], **kwargs)
+    
+    Solves the weights of each mesh for each of several stiffness values at
+    once, without applying any of them, and returns a WeightSweep holding all
+    the results; use its apply method to set the mesh's skinCluster (or a
+    skinned duplicate of the mesh) to the weights for any one stiffness, as
+    many times as you like, without solving again.
+    
+    The meshes and skeleton are only exported once, and all the solves are
+    run together, up to 'workers' at a time - which defaults to one per cpu
+    here.
+    
+    The args are as for heatWeight, and the keyword args are those of
+    heatWeight, except undoable and stiffness, plus:
+    stiffnessValues
+        A list of the stiffness values to solve for.  Required.
+    
+    If a cacheDir is given (see heatWeight) the results are also kept there,
+    so they need not be solved again by a later heatWeightSweep or heatWeight
+    call with the same stiffness.
+    
+    Returns None if the inputs were invalid.
+    """
+    if not args:
+        args = listForNone(cmds.ls(sl=1))
+    
+    stiffnessValues = list(kwargs.pop('stiffnessValues', []))
+    if not stiffnessValues:
+        raise ValueError("stiffnessValues must contain at least one value")
+    kwargs.setdefault('workers', None)
+    session = _SolveSession(kwargs)
+    
+    rootJoint, meshes, meshVertices = _getRootAndMeshes(args)
+    if rootJoint is None:
+        return None
+    
+    try:
+        jobs = session.solve(rootJoint, meshes, stiffnessValues)
+        if jobs is None:
+            return None
+    finally:
+        session.cleanup()
+    
+    sweep = WeightSweep(rootJoint, meshes, stiffnessValues)
+    sweep.vertices = meshVertices
+    for job in jobs:
+        if job.error is None:
+            sweep.skelList = job.skelList
+            sweep.weights[job.meshNum, job.stiffness] = job.weights
+        else:
+            sweep.errors[job.meshNum, job.stiffness] = job.error
+            api.MGlobal.displayWarning(
+                    "encountered exception while solving mesh %s with stiffness %s:\n%s"
+                    % (job.mesh, job.stiffness, job.error))
+    return sweep
+
+class WeightSweep(object):
+    """
+    The weights solved by heatWeightSweep, for each mesh at each stiffness.
+    
+    weights and errors are dicts keyed on (meshIndex, stiffness), holding the
+    bone weights (as SparseWeights) of each successful solve, and the error
+    message of each failed one.  vertices holds, for each mesh, the sorted
+    indices of the vertices to set if only components of it were swept, or
+    None.
+    """
+    def __init__(self, rootJoint, meshes, stiffnessValues):
+        self.rootJoint = rootJoint
+        self.meshes = meshes
+        self.stiffnessValues = stiffnessValues
+        self.vertices = [None] * len(meshes)
+        self.skelList = None
+        self.weights = {}
+        self.errors = {}
+    
+    def apply(self, stiffness, meshes=None, duplicate=False, undoable=None,
+              feather=0):
+        """
+        Sets the skin weights of each of the meshes (by default, all of the
+        swept meshes) to those solved with the given stiffness.  If only
+        components of a mesh were swept, just their weights are set,
+        feathered into the existing weights as for heatWeight.
+        
+        If duplicate is True, the meshes are left alone; instead each is
+        duplicated, and the duplicate bound to the skeleton and given the
+        weights, so the results for several stiffnesses may be compared side
+        by side.
+        
+        undoable is as for heatWeight.
+        
+        Returns the list of meshes which were weighted.
+        """
+        if stiffness not in self.stiffnessValues:
+            raise ValueError("stiffness %s was not one of the values swept"
+                             % stiffness)
+        if meshes is None:
+            meshIndices = range(len(self.meshes))
+        else:
+            meshIndices = [self._meshIndex(mesh) for mesh in meshes]
+        if undoable is None:
+            undoable = _getUndoable({})
+        
+        weighted = []
+        for meshIndex in meshIndices:
+            mesh = self.meshes[meshIndex]
+            weights = self.weights.get((meshIndex, stiffness))
+            if weights is None:
+                api.MGlobal.displayWarning(
+                        "no weights for mesh %s with stiffness %s"
+                        % (mesh, stiffness))
+                continue
+            if duplicate:
+                mesh = _duplicateMesh(mesh, '%s_stiffness%s' % (
+                                leafName(getParent(mesh)),
+                                str(stiffness).replace('.', '_')))
+            skin = _getOrMakeSkinCluster(mesh, self.rootJoint)
+            vertices = self.vertices[meshIndex]
+            blend = None
+            if vertices is not None:
+                vertices, blend = _featherVertices(mesh, vertices, feather)
+            pinocchioWeightsImport(mesh, skin, self.skelList,
+                                   undoable=undoable, weights=weights,
+                                   vertices=vertices, blend=blend)
+            weighted.append(mesh)
+        return weighted
+    
+    def _meshIndex(self, mesh):
+        for index, sweptMesh in enumerate(self.meshes):
+            if isSameObject(sweptMesh, mesh):
+                return index
+        for index, sweptMesh in enumerate(self.meshes):
+            if isSameObject(getParent(sweptMesh), mesh):
+                return index
+        raise ValueError("mesh %s was not one of the meshes swept" % mesh)
+
+def _getRootAndMeshes(args):
+    """
+    Sorts the args to heatWeight into the root joint, a list of meshes, and a
+    list of the vertices to weight on each of those meshes.
+    
+    The vertices are given (as a sorted list of indices) for meshes which were
+    only selected by their components - any mix of poly vertices, edges and
+    faces, which are all converted to vertices; they are None for meshes
+    which are to be weighted whole.
+    
+    If the args are invalid, displays an error and returns (None, None, None).
+    """
+    inputArgsMessage = "Select one root joint and meshes (or mesh components) you wish to weight"
+    meshes = []
+    meshVertices = []
+    meshIndices = {}
+    def addMesh(mesh, vertices=None):
+        key = dagPathKey(mesh)
+        if key not in meshIndices:
+            meshIndices[key] = len(meshes)
+            meshes.append(mesh)
+            meshVertices.append(vertices)
+            return
+        index = meshIndices[key]
+        if vertices is None or meshVertices[index] is None:
+            # The whole mesh was selected
+            meshVertices[index] = None
+        else:
+            meshVertices[index] = sorted(set(meshVertices[index]) |
+                                         set(vertices))
+    
+    rootJoint = None
+    for arg in args:
+        if _isComponent(arg):
+            shapes = listForNone(cmds.ls(arg, objectsOnly=True))
+            if len(shapes) != 1 or not isATypeOf(shapes[0], 'mesh'):
+                api.MGlobal.displayError(
+                    ("not a poly mesh component: %s - " % arg) +
+                    inputArgsMessage)
+                return None, None, None
+            addMesh(shapes[0], _componentIndices(
+                cmds.polyListComponentConversion(arg, toVertex=True)))
+        elif isATypeOf(arg, 'joint'):
+            if rootJoint is None:
+                rootJoint = arg
+            else:
+                api.MGlobal.displayError("multiple joints - " +
+                                         inputArgsMessage)
+                return None, None, None
+        elif isATypeOf(arg, 'mesh'):
+            addMesh(arg)
+        elif isATypeOf(arg, 'transform'):
+            shapes = [x for x in getShapes(arg) if isATypeOf(x, 'mesh')]
+            if len(shapes) == 0: 
+                api.MGlobal.displayWarning(
+                    "transform has no poly shape: %s" % arg)
+            else:
+                for shape in shapes:
+                    addMesh(shape)
+        else:
+            api.MGlobal.displayError(
+                ("not a poly mesh, transform, or joint: %s - " % arg) +
+                inputArgsMessage)
+            return None, None, None
+    if rootJoint is None:
+        api.MGlobal.displayError("no root joint - "  + inputArgsMessage)
+        return None, None, None
+    if not meshes:
+        api.MGlobal.displayError("no meshes - "  + inputArgsMessage)
+        return None, None, None
+    return rootJoint, meshes, meshVertices
+
+_COMPONENT_RE = re.compile(r'\.\w+\[[^\]]*\]$')
+_COMPONENT_INDICES_RE = re.compile(r'\[(\d+)(?::(\d+))?\]$')
+
+def _isComponent(node):
+    return bool(_COMPONENT_RE.search(node))
+
+def _componentIndices(components):
+    """
+    Returns the sorted indices of the given components - a list of names of the
+    form mesh.vtx[5] or mesh.vtx[2:7], all of the same type
+    """
+    indices = set()
+    for component in listForNone(components):
+        match = _COMPONENT_INDICES_RE.search(component)
+        if match is None:
+            raise PinocchioError("cannot read the indices of component %r"
+                                 % component)
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        indices.update(xrange(start, end + 1))
+    return sorted(indices)
+
+def _growVertices(mesh, vertices):
+    """
+    Returns the sorted indices of the given vertices of the mesh, and of all
+    the vertices which share an edge with them
+    """
+    edges = cmds.polyListComponentConversion(_vertexNames(mesh, vertices),
+                                             fromVertex=True, toEdge=True)
+    return _componentIndices(cmds.polyListComponentConversion(
+                                    edges, fromEdge=True, toVertex=True))
+
+def _featherVertices(mesh, vertices, feather):
+    """
+    Returns (vertices, blend) for weighting just the given vertices of the
+    mesh, feathered into the existing weights over 'feather' rings of the
+    surrounding vertices; see the blend arg of pinocchioWeightsImport.
+    
+    The given vertices get a blend of 1 (ie, just the new weights), and the
+    blend falls off linearly with each ring of vertices around them; if
+    feather is 0, blend is None.
+    """
+    if not feather:
+        return vertices, None
+    blends = dict((vertex, 1.0) for vertex in vertices)
+    ring = vertices
+    for ringNum in xrange(1, feather + 1):
+        ring = [vertex for vertex in _growVertices(mesh, ring)
+                if vertex not in blends]
+        if not ring:
+            break
+        for vertex in ring:
+            blends[vertex] = 1.0 - ringNum / (feather + 1.0)
+    vertices = sorted(blends)
+    return vertices, [blends[vertex] for vertex in vertices]
+
+def _getUndoable(kwargs):
+    if 'undoable' in kwargs:
+        return kwargs['undoable']
+    elif loadWeightsPlugin():
+        # The plugin gives us the speed of the api, and undo - no need to ask
+        return True
+    else:
+        return useUndoableMethod()
+
+def _getOrMakeSkinCluster(mesh, rootJoint):
+    skinClusters = getSkinClusters(mesh)
+    if skinClusters:
+        return skinClusters[0]
+    else:
+        return cmds.skinCluster(mesh, rootJoint, rui=False)[0]
+
+def _duplicateMesh(mesh, newName):
+    """
+    Duplicates the transform of the given mesh, without any intermediate
+    shapes left by deformers, and returns the new mesh shape.
+    """
+    newTransform = cmds.duplicate(getParent(mesh), name=newName)[0]
+    newMesh = None
+    for shape in getShapes(newTransform, noIntermediate=False):
+        if cmds.getAttr(shape + '.intermediateObject'):
+            cmds.delete(shape)
+        elif newMesh is None and isATypeOf(shape, 'mesh'):
+            newMesh = shape
+    return newMesh
+
+class _SolveSession(object):
+    """
+    The options and temporary files shared by the export and solve stages of
+    heatWeight and heatWeightSweep.
+    
+    The keyword args controlling exporting and solving (see heatWeight) are
+    popped from kwargs when it is made; cleanup must be called once finished
+    with the results of solve, to remove any temporary files.
+    """
+    def __init__(self, kwargs):
+        self.fit = kwargs.pop('fit', False)
+        self.tempOutputDir = kwargs.pop('tempOutputDir', None)
+        self.tempDelete = kwargs.pop('tempDelete', True)
+        self.tempOverwrite = kwargs.pop('tempOverwrite', True)
+        self.directDescendentsOnly = kwargs.pop('directDescendentsOnly', False)
+        self.workers = kwargs.pop('workers', 1)
+        if not self.workers or self.workers < 1:
+            self.workers = multiprocessing.cpu_count()
+        self.timeout = kwargs.pop('timeout', None)
+        self.progressCallback = kwargs.pop('progressCallback', None)
+        
+        self.tempStaging = kwargs.pop('tempStaging', 'disk')
+        if self.tempStaging not in ('disk', 'ram', 'fifo'):
+            raise ValueError("tempStaging must be 'disk', 'ram' or 'fifo' - got %r"
+                             % self.tempStaging)
+        if self.tempStaging == 'fifo' and not (hasattr(os, 'mkfifo') and
+                                               hasattr(api.MFnMesh, 'getTriangles')):
+            self.tempStaging = 'ram'
+        
+        self.cacheDir = kwargs.pop('cacheDir', os.environ.get(_CACHE_DIR_ENV))
+        self.cacheSize = kwargs.pop('cacheSize', None)
+        
+        self.engine = kwargs.pop('engine', 'pinocchio')
+        if self.engine not in ('pinocchio', 'python'):
+            raise ValueError("engine must be 'pinocchio' or 'python' - got %r"
+                             % self.engine)
+        if self.engine == 'python':
+            if numpy is None or scipy is None:
+                raise PinocchioError("the python engine requires numpy and scipy")
+            if not hasattr(api.MFnMesh, 'getTriangles'):
+                raise PinocchioError("the python engine requires MFnMesh.getTriangles")
+            if self.fit:
+                raise PinocchioError("fit is only supported by the pinocchio engine")
+        
+        self.proxyRatio = kwargs.pop('proxyRatio', None)
+        if self.proxyRatio is not None:
+            if not 0 < self.proxyRatio < 1:
+                raise ValueError("proxyRatio must be between 0 and 1 - got %r"
+                                 % self.proxyRatio)
+            if numpy is None or scipy is None:
+                raise PinocchioError("proxy meshes require numpy and scipy")
+            if not hasattr(api.MFnMesh, 'getTriangles'):
+                raise PinocchioError("proxy meshes require MFnMesh.getTriangles")
+        
+        # Merging needs the meshes' geometry, so is skipped if it can't be
+        # read with the api
+        self.merge = (kwargs.pop('merge', False) and
+                      hasattr(api.MFnMesh, 'getTriangles'))
+        self.mergeThreshold = kwargs.pop('mergeThreshold', _MERGE_THRESHOLD)
+        
+        self.skeleton = None
+        self.outputDir = None
+        self.cache = None
+        self.jobs = []
+        # Jobs for the solves of merged meshes, which are split into jobs for
+        # each mesh once solved
+        self.mergedJobs = []
+        self.tempFiles = []
+    
+    def solve(self, rootJoint, meshes, stiffnessValues):
+        """
+        Exports the skeleton and meshes, and solves the weights of each mesh
+        for each of the stiffnessValues.
+        
+        Returns a list of _MeshJobs, one per mesh and stiffness (ordered by
+        mesh, then stiffness), each of which either has its weights read, or
+        an error set; or None, if the skeleton could not be exported.
+        """
+        if self.tempOutputDir:
+            self.outputDir = self.tempOutputDir
+        elif self.tempStaging != 'disk' and os.path.isdir(_RAM_DIR):
+            self.outputDir = tempfile.mkdtemp(dir=_RAM_DIR)
+        else:
+            self.outputDir = tempfile.mkdtemp()
+        
+        if self.cacheDir and (self.engine == 'python' or
+                              os.path.isfile(_PINOCCHIO_BIN)):
+            if self.cacheSize:
+                self.cache = WeightCache(self.cacheDir,
+                                         maxSize=int(self.cacheSize * (1 << 20)))
+            else:
+                self.cache = WeightCache(self.cacheDir)
+        
+        _solvesCancelled.clear()
+        
+        # The skeleton is the same for every mesh, so only export it once
+        skelFilePath = os.path.join(self.outputDir,
+                                    'skel_%s.skel' % leafName(rootJoint))
+        if (not self.tempOverwrite) and os.path.exists(skelFilePath):
+            api.MGlobal.displayError("file %r already exists" % skelFilePath)
+            return None
+        self.tempFiles.append(skelFilePath)
+        try:
+            self.skeleton = skeleton = getPinocchioSkeleton(rootJoint,
+                            directDescendentsOnly=self.directDescendentsOnly)
+            if self.engine == 'pinocchio':
+                skeleton.writeFile(skelFilePath)
+        except Exception, e:
+            api.MGlobal.displayError(
+                    "encountered exception while exporting skeleton %s:\n%s"
+                    % (rootJoint, _formatException(e)))
+            return None
+        
+        pinocchioMeshes = {}
+        mergedMeshes = []
+        if self.merge:
+            mergedMeshes = self._getMergedMeshes(meshes, pinocchioMeshes)
+        mergedNums = set(meshNum for meshNum, mesh, start, end in mergedMeshes)
+        
+        # Export everything first, so that all the binaries may be run at once
+        for meshNum, mesh in enumerate(meshes):
+            if meshNum in mergedNums:
+                continue
+            meshJobs = [_MeshJob(meshNum, mesh, stiffness)
+                        for stiffness in stiffnessValues]
+            self.jobs.extend(meshJobs)
+            try:
+                self._exportMesh(meshJobs, skelFilePath,
+                                 pinocchioMesh=pinocchioMeshes.get(meshNum))
+            except Exception, e:
+                for job in meshJobs:
+                    job.error = _formatException(e)
+        if mergedMeshes:
+            self.mergedJobs = [_MeshJob(len(meshes), None, stiffness)
+                               for stiffness in stiffnessValues]
+            mergedMesh = PinocchioMesh.concatenate(
+                [pinocchioMeshes[meshNum] for meshNum, mesh, start, end
+                 in mergedMeshes])
+            for job in self.mergedJobs:
+                job.mergedMeshes = mergedMeshes
+            try:
+                self._exportMesh(self.mergedJobs, skelFilePath,
+                                 pinocchioMesh=mergedMesh)
+            except Exception, e:
+                for job in self.mergedJobs:
+                    job.error = _formatException(e)
+        
+        solveJobs = [job for job in self.jobs + self.mergedJobs
+                     if job.error is None and job.weights is None]
+        if len(stiffnessValues) == 1:
+            solveName = 'meshes'
+        else:
+            solveName = 'solves'
+        showProgress = solveJobs and not cmds.about(batch=True)
+        if showProgress:
+            cmds.progressWindow(title="Solving weights...", isInterruptable=True,
+                                max=len(solveJobs))
+        try:
+            def poll(numFinished, numTotal):
+                if cmds.progressWindow(query=True, isCancelled=True):
+                    cancelSolves()
+                cmds.progressWindow(edit=True, progress=numFinished,
+                                    status="Solved %i of %i %s" % (numFinished, numTotal, solveName))
+            results = _runInPool([self._makeSolve(job) for job in solveJobs],
+                                 workers=self.workers,
+                                 poll=(poll if showProgress else None))
+        finally:
+            if showProgress:
+                cmds.progressWindow(endProgress=True)
+        for job, (result, error) in zip(solveJobs, results):
+            job.error = error
+        
+        for job in self.jobs + self.mergedJobs:
+            if job.error is None and job.fullMesh is not None:
+                try:
+                    self._transferWeights(job)
+                except Exception, e:
+                    job.error = _formatException(e)
+        
+        if self.mergedJobs:
+            self._splitMergedJobs()
+        return self.jobs
+    
+    def _getMergedMeshes(self, meshes, pinocchioMeshes):
+        """
+        Reads the geometry of each of the meshes into pinocchioMeshes (a dict
+        keyed on the mesh's index), and picks out those with no more than
+        mergeThreshold vertices to be solved together as a single mesh.
+        
+        Returns a list of (meshNum, mesh, startVertex, endVertex) for each
+        mesh to merge, giving the range of vertices it will have in the merged
+        mesh; or an empty list, if fewer than two meshes are small enough.
+        """
+        mergedMeshes = []
+        numVertices = 0
+        for meshNum, mesh in enumerate(meshes):
+            try:
+                pinocchioMesh = getPinocchioMesh(mesh)
+            except Exception:
+                # Leave it to be exported on its own, so the error is reported
+                # for that mesh
+                continue
+            pinocchioMeshes[meshNum] = pinocchioMesh
+            if pinocchioMesh.numVertices <= self.mergeThreshold:
+                mergedMeshes.append((meshNum, mesh, numVertices,
+                                     numVertices + pinocchioMesh.numVertices))
+                numVertices += pinocchioMesh.numVertices
+        if len(mergedMeshes) < 2:
+            return []
+        return mergedMeshes
+    
+    def _splitMergedJobs(self):
+        """
+        Makes a job for each of the merged meshes from each merged job, with
+        that mesh's rows of the weights (or the merged job's error), and adds
+        them to the jobs, keeping them ordered by mesh, then stiffness.
+        """
+        for mergedJob in self.mergedJobs:
+            for meshNum, mesh, start, end in mergedJob.mergedMeshes:
+                job = _MeshJob(meshNum, mesh, mergedJob.stiffness)
+                job.skelList = mergedJob.skelList
+                job.error = mergedJob.error
+                if mergedJob.weights is not None:
+                    job.weights = mergedJob.weights.takeRows(xrange(start, end))
+                self.jobs.append(job)
+        stiffnessIndices = dict((job.stiffness, i)
+                                for i, job in enumerate(self.mergedJobs))
+        self.jobs.sort(key=lambda job: (job.meshNum,
+                                        stiffnessIndices[job.stiffness]))
+    
+    def _exportMesh(self, meshJobs, skelFilePath, pinocchioMesh=None):
+        """
+        Exports the mesh for a list of jobs which differ only in stiffness,
+        setting their file paths, and looking up their weights in the cache.
+        
+        If the mesh's geometry has already been read, it may be given as
+        pinocchioMesh; for merged jobs, it must be.
+        """
+        skeleton = self.skeleton
+        mesh = meshJobs[0].mesh
+        meshNum = meshJobs[0].meshNum
+        if mesh is None:
+            meshName = 'merged'
+        else:
+            meshName = leafName(mesh)
+        
+        def makeFilename(prefix, suffix, job=None):
+            # We include the meshNum in the name to ensure that each filename is unique;
+            # we cannot simply use mesh.name(), which would return a unique name, as it might
+            # include characters - such as '|' - that windows won't allow as a filename
+            baseName = '%s%d_%s' % (prefix, meshNum, meshName)
+            if job is not None and len(meshJobs) > 1:
+                baseName += '_s%d' % meshJobs.index(job)
+            newName = os.path.join(self.outputDir, baseName + suffix)
+            if (not self.tempOverwrite) and os.path.exists(newName):
+                raise CannotOverwriteError("file %r already exists" % newName)
+            if job is None:
+                self.tempFiles.append(newName)
+            else:
+                job.tempFiles.append(newName)
+            return newName
+        
+        # Unless streaming, the obj file is shared by all the jobs
+        objFilePath = makeFilename('model', '.obj')
+        fullMesh = proxyVertexMap = None
+        if pinocchioMesh is not None or hasattr(api.MFnMesh, 'getTriangles'):
+            if pinocchioMesh is None:
+                pinocchioMesh = getPinocchioMesh(mesh)
+            if self.proxyRatio is not None:
+                # Everything from here on uses the proxy, until the weights
+                # are transferred back to the full mesh
+                fullMesh = pinocchioMesh
+                pinocchioMesh, proxyVertexMap = makeProxyMesh(fullMesh,
+                                                              self.proxyRatio)
+        else:
+            # Older api - the mesh can only be exported to a file
+            pinocchioMesh = None
+            pinocchioObjExport(mesh, objFilePath)
+        
+        objDigest = None
+        for job in meshJobs:
+            job.skelFilePath = skelFilePath
+            job.skelList = skeleton.skelList
+            job.pinocchioMesh = pinocchioMesh
+            job.fullMesh = fullMesh
+            job.proxyVertexMap = proxyVertexMap
+            job.objFilePath = objFilePath
+            job.outSkelPath = makeFilename('outSkel', '.skel', job)
+            job.outWeightPath = makeFilename('weight', '.weight', job)
+            
+            if self.cache is not None:
+                if objDigest is None:
+                    if pinocchioMesh is not None:
+                        objDigest = pinocchioMesh.digest()
+                    else:
+                        objDigest = fileDigest(objFilePath)
+                if self.engine == 'python':
+                    solverDigest = PYTHON_SOLVER_VERSION
+                else:
+                    solverDigest = binaryDigest()
+                job.cacheKey = WeightCache.makeKey(objDigest, skeleton.text,
+                                                   job.stiffness, self.fit,
+                                                   solverDigest)
+                # If found, there's no need to solve this one again
+                job.weights = self.cache.get(job.cacheKey)
+        
+        unsolved = [job for job in meshJobs if job.weights is None]
+        if pinocchioMesh is None or not unsolved or self.engine == 'python':
+            # Nothing (more) to write
+            return
+        if self.tempStaging == 'fifo':
+            for job in unsolved:
+                if len(meshJobs) > 1:
+                    # Each binary needs its own stream of the mesh
+                    job.objFilePath = makeFilename('model', '.obj', job)
+                job.useFifos = _makeFifos(job.objFilePath, job.outWeightPath)
+            if all(job.useFifos for job in unsolved):
+                return
+        pinocchioMesh.writeObj(objFilePath)
+        for job in unsolved:
+            if not job.useFifos:
+                job.objFilePath = objFilePath
+    
+    def _makeSolve(self, job):
+        def solve():
+            if self.engine == 'python':
+                if _solvesCancelled.isSet():
+                    raise SolveCancelledError("solve cancelled before starting")
+                job.weights = solveHeatWeights(job.pinocchioMesh, self.skeleton,
+                                               stiffness=job.stiffness)
+            elif job.useFifos:
+                job.weights = runPinocchioBinWithFifos(job.pinocchioMesh,
+                                job.objFilePath, job.skelFilePath,
+                                job.outWeightPath,
+                                fit=self.fit, stiffness=job.stiffness,
+                                skelOut=job.outSkelPath,
+                                progressCallback=self.progressCallback,
+                                timeout=self.timeout)
+            else:
+                runPinocchioBin(job.objFilePath, job.skelFilePath,
+                                fit=self.fit, stiffness=job.stiffness,
+                                skelOut=job.outSkelPath, weightOut=job.outWeightPath,
+                                progressCallback=self.progressCallback,
+                                timeout=self.timeout)
+                job.weights = readPinocchioSparseWeights(job.outWeightPath)
+            if job.cacheKey is not None:
+                try:
+                    self.cache.put(job.cacheKey, job.weights)
+                except (IOError, OSError):
+                    # Not being able to cache the result shouldn't stop us
+                    # from using it
+                    if DEBUG:
+                        traceback.print_exc()
+        return solve
+    
+    def _transferWeights(self, job):
+        """
+        Replaces the weights solved on a job's proxy mesh with those transferred
+        to its full mesh, and reports the transfer error.
+        """
+        job.weights, job.transferError = transferWeights(job.weights,
+                                                         job.pinocchioMesh,
+                                                         job.fullMesh,
+                                                         job.proxyVertexMap)
+        error = job.transferError
+        if job.mergedMeshes is None:
+            meshName = job.mesh
+        else:
+            meshName = 'of merged meshes'
+        print ("solved mesh %s on a proxy of %d of its %d vertices - distance "
+               "to proxy: mean %.4g, max %.4g (%.2f%% of the mesh's size); "
+               "weight change: mean %.4g, max %.4g"
+               % (meshName, job.pinocchioMesh.numVertices,
+                  job.fullMesh.numVertices, error['meanDistance'],
+                  error['maxDistance'],
+                  100 * error['maxDistance'] / max(error['size'], 1e-12),
+                  error['meanWeightChange'], error['maxWeightChange']))
+    
+    def cleanup(self):
+        """
+        Removes the temporary files, if tempDelete was set.
+        """
+        if not self.tempDelete or self.outputDir is None:
+            return
+        tempFiles = list(self.tempFiles)
+        for job in self.jobs + self.mergedJobs:
+            tempFiles.extend(job.tempFiles)
+        for tempFile in tempFiles:
+            # lexists, rather than isfile, so fifos are removed too
+            if os.path.lexists(tempFile):
+                os.remove(tempFile)
+        if os.path.isdir(self.outputDir) and not os.listdir(self.outputDir):
+            os.rmdir(self.outputDir)
+
+class _MeshJob(object):
+    """
+    Holds the state for a single solve of a mesh as it passes through the
+    export, solve, and import stages of heatWeight.
+    """
+    def __init__(self, meshNum, mesh, stiffness=1.0):
+        self.meshNum = meshNum
+        self.mesh = mesh
+        self.stiffness = stiffness
+        self.skin = None
+        self.skelList = None
+        self.objFilePath = None
+        self.skelFilePath = None
+        self.outSkelPath = None
+        self.outWeightPath = None
+        # The mesh's geometry, if it could be read with the api - or that of its
+        # proxy, if solving on one, in which case fullMesh is the mesh's, and
+        # proxyVertexMap / transferError are as for makeProxyMesh /
+        # transferWeights
+        self.pinocchioMesh = None
+        self.fullMesh = None
+        self.proxyVertexMap = None
+        self.transferError = None
+        # For the solve of several merged meshes (in which case mesh is None),
+        # the (meshNum, mesh, startVertex, endVertex) of each
+        self.mergedMeshes = None
+        # Whether the mesh / weights are streamed to / from the binary through
+        # fifos
+        self.useFifos = False
+        # Set once the weights are read from the cache / the solve
+        self.weights = None
+        self.cacheKey = None
+        self.tempFiles = []
+        # Set to the formatted exception, if any stage fails
+        self.error = None
+
+def _runInPool(funcs, workers=1, poll=None):
+    """
+    Calls each of the given no-argument callables, with at most 'workers' of
+    them running at once, and waits for all of them to finish.
+    
+    Returns a list of (result, error) pairs, in the same order as funcs,
+    where error is None if the call succeeded, or the formatted exception if
+    it raised.
+    
+    If poll is given, it is called from the calling thread every so often
+    while waiting, as poll(numFinished, numTotal).
+    
+    Since the callables are run in separate threads (unless workers is 1 and
+    there is no poll), they must not use maya.cmds or the maya api; this is
+    intended for waiting on external processes, such as the Pinocchio binary,
+    so threads are all that is needed to keep several of them running at once.
+    """
+    results = [None] * len(funcs)
+    
+    def call(index, func):
+        try:
+            results[index] = (func(), None)
+        except Exception, e:
+            results[index] = (None, _formatException(e))
+    
+    if poll is None and (workers == 1 or len(funcs) <= 1):
+        for index, func in enumerate(funcs):
+            call(index, func)
+        return results
+    
+    todo = Queue.Queue()
+    for index, func in enumerate(funcs):
+        todo.put((index, func))
+    
+    def worker():
+        while True:
+            try:
+                index, func = todo.get_nowait()
+            except Queue.Empty:
+                return
+            call(index, func)
+    
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(workers, len(funcs)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        while thread.isAlive():
+            thread.join(_POLL_INTERVAL)
+            if poll is not None:
+                poll(len([x for x in results if x is not None]), len(funcs))
+    return results
+
+def _formatException(e):
+    if DEBUG:
+        return traceback.format_exc()
+    else:
+        return str(e)
+
+#==============================================================================
+# Python Solver
+#==============================================================================
+
+# Identifies the results of the python solver in the weight cache, in place of
+# the binary's digest; bump if the results it gives change
+PYTHON_SOLVER_VERSION = 'python-1'
+
+# These mirror the constants used by Pinocchio's attachment code
+_TIE_TOLERANCE = 1.0001
+_HEAT_TIE_TOLERANCE = 1.00001
+_MIN_HEAT_WEIGHT = 1e-8
+# Number of neighbouring segments to find the nearby triangles for at once
+_SEGMENT_BLOCK_SIZE = 64
+# Max number of segment / triangle pairs to test for intersections at once
+_INTERSECT_BLOCK_SIZE = 1 << 18
+
+def solveHeatWeights(pinocchioMesh, skeleton, stiffness=1.0, useCache=True):
+    """
+    Solves the bone heat weights of the mesh for the skeleton (a
+    PinocchioSkeleton) in-process, using numpy and scipy, giving the same
+    weights as running the Pinocchio binary without fit.
+    
+    As in Pinocchio, each bone's weights are found by solving
+        (L + H) w = H p
+    where L is the cotangent laplacian of the mesh, H a diagonal matrix of
+    stiffness / (distance to the nearest bone) ** 2 for each vertex which can
+    'see' its nearest bone (ie, the line to it doesn't pass out of the mesh),
+    and p is 1 where the vertex's nearest bone is this bone, and 0 otherwise.
+    
+    If useCache is True, the parts of the solve which depend only on the mesh
+    (the laplacian, etc.) are kept between calls, along with which vertices
+    can see each bone, and the factorizations of the last few systems solved;
+    so solving the same mesh again - after moving a joint, or with the same
+    skeleton and stiffness - only redoes the work that has changed.  See
+    clearHeatSolverCache.
+    
+    Returns a SparseWeights, with one column per bone.
+    """
+    if numpy is None or scipy is None:
+        raise PinocchioError("the python solver requires numpy and scipy")
+    
+    points = numpy.asarray(pinocchioMesh.points, dtype=numpy.float64).reshape(-1, 3)
+    triangles = numpy.asarray(pinocchioMesh.triangles, dtype=numpy.int32).reshape(-1, 3)
+    if useCache:
+        system = _getHeatSystem(points, triangles)
+    else:
+        system = _HeatSystem(points, triangles)
+    numVerts = system.numVertices
+    
+    joints = system.normalize(numpy.asarray(skeleton.positions, dtype=numpy.float64))
+    boneJoints = [(jointIndex, parentIndex) for jointIndex, (joint, parentIndex)
+                  in enumerate(skeleton.skelList) if parentIndex >= 0]
+    boneStarts = joints[[parent for joint, parent in boneJoints]]
+    boneEnds = joints[[joint for joint, parent in boneJoints]]
+    numBones = len(boneJoints)
+    
+    # Distances to the bones, and the point on each bone nearest each vertex
+    nearest, boneDists = _nearestPointsOnBones(system.points, boneStarts, boneEnds)
+    minDists = boneDists.min(axis=1)
+    closest = boneDists.argmin(axis=1)
+    
+    # Whether each vertex can see each of its (equally) nearest bones
+    visible = boneDists <= (minDists * _TIE_TOLERANCE)[:, None]
+    verts, bones = numpy.nonzero(visible)
+    visible[verts, bones] = system.visibility(verts, bones, boneStarts, boneEnds,
+                                              nearest[verts, bones],
+                                              useCache=useCache)
+    
+    heatBones = visible & (boneDists <= (minDists * _HEAT_TIE_TOLERANCE)[:, None])
+    heat = stiffness * heatBones.sum(axis=1) / \
+        (_MIN_HEAT_WEIGHT + boneDists[numpy.arange(numVerts), closest]) ** 2
+    # Pinocchio solves the area-weighted system, with twice the area of all the
+    # triangles around each vertex
+    heat *= 1e-10 + system.vertAreas
+    
+    # One bone at a time, as Pinocchio does - this also keeps the memory used
+    # by the solve down to a single column
+    factor = system.factor(heat, useCache=useCache)
+    weights = numpy.empty((numVerts, numBones))
+    for bone in xrange(numBones):
+        weights[:, bone] = factor.solve(numpy.where(heatBones[:, bone], heat, 0.))
+    numpy.minimum(weights, 1., out=weights)
+    weights[weights <= _MIN_HEAT_WEIGHT] = 0.
+    sums = weights.sum(axis=1)
+    sums[sums == 0] = 1.
+    weights /= sums[:, None]
+    return SparseWeights.fromDense(weights)
+
+# Number of meshes, and of factorizations per mesh, for solveHeatWeights to
+# keep; factorizations of large meshes can take a lot of memory
+_HEAT_SYSTEM_CACHE_SIZE = 4
+_FACTOR_CACHE_SIZE = 4
+
+# (key, _HeatSystem) pairs, most recently used last
+_heatSystemCache = []
+_heatSystemCacheLock = threading.Lock()
+
+def _getHeatSystem(points, triangles):
+    digest = hashlib.sha1(points.tostring())
+    digest.update(triangles.tostring())
+    key = digest.hexdigest()
+    _heatSystemCacheLock.acquire()
+    try:
+        for i, (cachedKey, system) in enumerate(_heatSystemCache):
+            if cachedKey == key:
+                del _heatSystemCache[i]
+                _heatSystemCache.append((key, system))
+                return system
+    finally:
+        _heatSystemCacheLock.release()
+    
+    # Made outside of the lock, so other meshes can be solved meanwhile
+    system = _HeatSystem(points, triangles)
+    _heatSystemCacheLock.acquire()
+    try:
+        _heatSystemCache.append((key, system))
+        del _heatSystemCache[:-_HEAT_SYSTEM_CACHE_SIZE]
+    finally:
+        _heatSystemCacheLock.release()
+    return system
+
+def clearHeatSolverCache():
+    """
+    Frees everything kept between calls to solveHeatWeights.
+    """
+    _heatSystemCacheLock.acquire()
+    try:
+        del _heatSystemCache[:]
+    finally:
+        _heatSystemCacheLock.release()
+
+class _HeatSystem(object):
+    """
+    The parts of the heat equation for a mesh which don't depend on the
+    skeleton, plus caches of those that depend on it in ways which can be
+    reused: which vertices can see each bone, and the factorizations of the
+    system for particular heat values.
+    
+    All positions are in the mesh's normalized space - see normalize.
+    """
+    def __init__(self, points, triangles):
+        self.numVertices = numVerts = len(points)
+        self.triangles = triangles
+        
+        # Scale to fit in a unit box, as Pinocchio does, so that its epsilons
+        # mean the same thing regardless of the scene's units
+        self.minPoint = points.min(axis=0)
+        self.scale = 1. / max((points.max(axis=0) - self.minPoint).max(), 1e-37)
+        self.points = points = self.normalize(points)
+        
+        corners = [points[triangles[:, i]] for i in xrange(3)]
+        faceCross = numpy.cross(corners[1] - corners[0], corners[2] - corners[0])
+        faceCrossLength = numpy.sqrt((faceCross ** 2).sum(axis=1))
+        
+        faceNormals = faceCross / numpy.maximum(faceCrossLength, 1e-37)[:, None]
+        self.vertNormals = numpy.zeros((numVerts, 3))
+        self.vertAreas = numpy.zeros(numVerts)
+        for i in xrange(3):
+            for axis in xrange(3):
+                self.vertNormals[:, axis] += numpy.bincount(triangles[:, i],
+                                                weights=faceNormals[:, axis],
+                                                minlength=numVerts)
+            self.vertAreas += numpy.bincount(triangles[:, i],
+                                             weights=faceCrossLength,
+                                             minlength=numVerts)
+        self.vertNormals /= numpy.maximum(
+                numpy.sqrt((self.vertNormals ** 2).sum(axis=1)), 1e-37)[:, None]
+        
+        # Cotangent laplacian - each angle's cotangent weights the edge opposite
+        rows = []
+        columns = []
+        values = []
+        for i in xrange(3):
+            a, b, c = i, (i + 1) % 3, (i + 2) % 3
+            edge1 = corners[b] - corners[a]
+            edge2 = corners[c] - corners[a]
+            cot = (edge1 * edge2).sum(axis=1) / \
+                (1e-6 + numpy.sqrt((numpy.cross(edge1, edge2) ** 2).sum(axis=1)))
+            rows.extend((triangles[:, b], triangles[:, c]))
+            columns.extend((triangles[:, c], triangles[:, b]))
+            values.extend((-cot, -cot))
+        self.laplacian = scipy.sparse.coo_matrix(
+                (numpy.concatenate(values),
+                 (numpy.concatenate(rows), numpy.concatenate(columns))),
+                shape=(numVerts, numVerts)).tocsr()
+        self.laplacianDiagonal = -numpy.asarray(self.laplacian.sum(axis=1)).ravel()
+        
+        self.triPoints = points[triangles]
+        self.triMins = self.triPoints.min(axis=1)
+        self.triMaxs = self.triPoints.max(axis=1)
+        
+        self._lock = threading.Lock()
+        # Keyed on a bone's (start, end); the values are boolean arrays of
+        # which vertices have been tested against the bone, and which of them
+        # can see it
+        self._visibility = {}
+        # (heat digest, factorization) pairs, most recently used last
+        self._factors = []
+    
+    def normalize(self, positions):
+        return (positions - self.minPoint) * self.scale
+    
+    def visibility(self, verts, bones, boneStarts, boneEnds, nearest,
+                   useCache=True):
+        """
+        Returns whether each of the verts can see the corresponding bone, whose
+        nearest point to the vertex is given.
+        """
+        toVert = self.points[verts] - nearest
+        toVert /= numpy.maximum(numpy.sqrt((toVert ** 2).sum(axis=1)),
+                                1e-37)[:, None]
+        inCone = (toVert * self.vertNormals[verts]).sum(axis=1) > .5
+        if not useCache:
+            return inCone & ~self._segmentsBlocked(verts, nearest, bones)
+        
+        # Only test the pairs we haven't already; since the nearest point
+        # depends only on the vertex and the bone's ends, so does the result
+        result = numpy.zeros(len(verts), dtype=bool)
+        boneKeys = [(tuple(start), tuple(end))
+                    for start, end in zip(boneStarts, boneEnds)]
+        self._lock.acquire()
+        try:
+            for bone, key in enumerate(boneKeys):
+                if key not in self._visibility:
+                    self._visibility[key] = (
+                            numpy.zeros(self.numVertices, dtype=bool),
+                            numpy.zeros(self.numVertices, dtype=bool))
+            cached = dict((bone, self._visibility[key])
+                          for bone, key in enumerate(boneKeys))
         finally:
-            cmds.flushUndo()
-            cmds.undoInfo(state=undoState)
-    else:
-        # Use mel skinPercent - much slower, but undoable
-        cmds.progressWindow(title="Setting new weights...", isInterruptable=True,
-                            max=numVertices)
+            self._lock.release()
+        tested = numpy.zeros(len(verts), dtype=bool)
+        for bone, (boneTested, boneVisible) in cached.iteritems():
+            pairs = numpy.nonzero(bones == bone)[0]
+            tested[pairs] = boneTested[verts[pairs]]
+            result[pairs] = boneVisible[verts[pairs]]
+        
+        untested = numpy.nonzero(~tested)[0]
+        if len(untested):
+            result[untested] = inCone[untested] & ~self._segmentsBlocked(
+                    verts[untested], nearest[untested], bones[untested])
+            for bone, (boneTested, boneVisible) in cached.iteritems():
+                pairs = untested[bones[untested] == bone]
+                boneVisible[verts[pairs]] = result[pairs]
+                boneTested[verts[pairs]] = True
+        
+        # Forget bones which have moved away, so joint edits don't pile up
+        self._lock.acquire()
         try:
-            lastUpdateTime = cmds.timerX()
-            updateInterval = .5
-            for vertIndex, vertJoints in enumerate(vertJointWeights):
-                jointValues = {}
-                if cmds.progressWindow( query=True, isCancelled=True ) :
-                    break
-                #print "weighting vert:", vertIndex
-                for jointIndex, jointValue in enumerate(vertJoints):
-                    if jointValue > 0:
-                        jointValues[pinocInfluences[jointIndex]] = jointValue
+            if len(self._visibility) > 2 * len(boneKeys):
+                current = set(boneKeys)
+                for key in self._visibility.keys():
+                    if key not in current:
+                        del self._visibility[key]
+        finally:
+            self._lock.release()
+        return result
+    
+    def factor(self, heat, useCache=True):
+        """
+        Returns the LU factorization of the laplacian plus the given heat
+        values, with a solve method.
+        """
+        key = hashlib.sha1(heat.tostring()).hexdigest()
+        if useCache:
+            self._lock.acquire()
+            try:
+                for i, (cachedKey, factor) in enumerate(self._factors):
+                    if cachedKey == key:
+                        del self._factors[i]
+                        self._factors.append((key, factor))
+                        return factor
+            finally:
+                self._lock.release()
         
-                if cmds.timerX(startTime=lastUpdateTime) > updateInterval:
-                    cmds.progressWindow(edit=True,
-                                        progress=vertIndex,
-                                        status="Setting Vert: (%i of %i)" % (vertIndex, numVertices))
-                    lastUpdateTime = cmds.timerX()
+        system = self.laplacian + \
+            scipy.sparse.diags(self.laplacianDiagonal + heat, 0)
+        factor = scipy.sparse.linalg.splu(system.tocsc())
+        if useCache:
+            self._lock.acquire()
+            try:
+                self._factors.append((key, factor))
+                del self._factors[:-_FACTOR_CACHE_SIZE]
+            finally:
+                self._lock.release()
+        return factor
     
-                cmds.skinPercent(skin, mesh + ".vtx[%d]" % vertIndex, normalize=False,
-                                 transformValue=jointValues.items())
-        finally:
-            cmds.progressWindow(endProgress=True)    
+    def _segmentsBlocked(self, verts, ends, groups):
+        """
+        For segments from each of the given vertices to the corresponding end
+        point, returns a boolean array of whether each passes through any of
+        the triangles, other than those around its vertex.
+        
+        Segments are tested in small blocks of neighbouring segments from the
+        same group (ie, bone), against only the triangles near that block.
+        """
+        blocked = numpy.zeros(len(verts), dtype=bool)
+        starts = self.points[verts]
+        for group in numpy.unique(groups):
+            segments = numpy.nonzero(groups == group)[0]
+            # Sort along the bone, so each block covers just a slice of the mesh
+            groupEnds = ends[segments]
+            axis = (groupEnds.max(axis=0) - groupEnds.min(axis=0)).argmax()
+            segments = segments[groupEnds[:, axis].argsort()]
+            for blockStart in xrange(0, len(segments), _SEGMENT_BLOCK_SIZE):
+                block = segments[blockStart:blockStart + _SEGMENT_BLOCK_SIZE]
+                blockMin = numpy.minimum(starts[block].min(axis=0),
+                                         ends[block].min(axis=0))
+                blockMax = numpy.maximum(starts[block].max(axis=0),
+                                         ends[block].max(axis=0))
+                nearTris = numpy.nonzero(((self.triMaxs >= blockMin) &
+                                          (self.triMins <= blockMax)).all(axis=1))[0]
+                if not len(nearTris):
+                    continue
+                chunkSize = max(1, _INTERSECT_BLOCK_SIZE // len(nearTris))
+                for chunkStart in xrange(0, len(block), chunkSize):
+                    chunk = block[chunkStart:chunkStart + chunkSize]
+                    blocked[chunk] = _intersectSegments(starts[chunk], ends[chunk],
+                                                        self.triPoints[nearTris],
+                                                        self.triangles[nearTris],
+                                                        verts[chunk])
+        return blocked
 
-def useUndoableMethod():
-    message = \
-    '''This script works in two modes:
-    slow, but undoable
-    faster, but clears undo
+def _nearestPointsOnBones(points, boneStarts, boneEnds):
+    """
+    Returns a (numPoints x numBones x 3) array of the nearest point on each
+    bone to each point, and a (numPoints x numBones) array of the distances to
+    them.
+    """
+    boneVectors = boneEnds - boneStarts
+    boneLengthsSq = numpy.maximum((boneVectors ** 2).sum(axis=1), 1e-37)
+    toPoints = points[:, None, :] - boneStarts[None, :, :]
+    params = (toPoints * boneVectors[None, :, :]).sum(axis=2) / boneLengthsSq
+    numpy.clip(params, 0., 1., out=params)
+    nearest = boneStarts[None, :, :] + params[:, :, None] * boneVectors[None, :, :]
+    dists = numpy.sqrt(((points[:, None, :] - nearest) ** 2).sum(axis=2))
+    return nearest, dists
+
+def _intersectSegments(starts, ends, triPoints, triangles, startVerts):
+    """
+    Moller-Trumbore intersection of each segment against every triangle;
+    returns a boolean array of whether each segment hits any triangle which
+    doesn't include its start vertex.
+    """
+    edge1 = (triPoints[:, 1] - triPoints[:, 0])[None]
+    edge2 = (triPoints[:, 2] - triPoints[:, 0])[None]
+    directions = (ends - starts)[:, None]
+    pvec = numpy.cross(directions, edge2)
+    det = (edge1 * pvec).sum(axis=2)
+    valid = abs(det) > 1e-12
+    invDet = 1. / numpy.where(valid, det, 1.)
+    tvec = starts[:, None] - triPoints[None, :, 0]
+    u = (tvec * pvec).sum(axis=2) * invDet
+    qvec = numpy.cross(tvec, edge1)
+    v = (directions * qvec).sum(axis=2) * invDet
+    t = (edge2 * qvec).sum(axis=2) * invDet
+    hits = valid & (u >= 0.) & (v >= 0.) & (u + v <= 1.) & (t > 1e-6) & (t <= 1.)
+    hits &= (triangles[None] != startVerts[:, None, None]).all(axis=2)
+    return hits.any(axis=1)
+
+#==============================================================================
+# Proxy Meshes
+#==============================================================================
+
+# Number of times to adjust the cell size to get near the target vertex count,
+# and how near is near enough
+_PROXY_ITERATIONS = 8
+_PROXY_TOLERANCE = 0.05
+# Number of proxy triangles (with the nearest centers) to find the closest
+# point on, for each vertex
+_TRANSFER_CANDIDATES = 8
+# Number of vertices to transfer weights to at once
+_TRANSFER_BLOCK_SIZE = 1 << 16
+
+def makeProxyMesh(pinocchioMesh, ratio):
+    """
+    Returns (proxyMesh, vertexMap) for a decimated copy of the mesh (a
+    PinocchioMesh), with about ratio times as many vertices, for solving the
+    weights of very dense meshes; see transferWeights.
     
-Which do you prefer?'''
-    undoable = 'Undoable'
-    faster = 'Faster'
-    button = cmds.confirmDialog(title='Confirm', message=message,
-                                button=[undoable,faster],
-                                defaultButton=undoable,
-                                cancelButton=undoable,
-                                dismissString=undoable)
-    if button == faster:
-        return False
-    else:
-        return True
+    The mesh is simplified by vertex clustering: the vertices in each cell of
+    a uniform grid (sized to give the wanted number of vertices) are merged
+    into one, at their average position. Triangles left degenerate or
+    duplicated are removed, as are any extra triangles on edges shared by
+    more than two, and the resulting borders closed, so each edge of the
+    proxy is used by exactly two triangles. Note that parts of the mesh closer
+    together than the cell size may be merged.
+    
+    vertexMap gives, for each vertex of the mesh, the index of the proxy vertex
+    it was merged into, or -1 if that was removed.
+    """
+    if numpy is None:
+        raise PinocchioError("proxy meshes require numpy")
+    points = numpy.asarray(pinocchioMesh.points, dtype=numpy.float64).reshape(-1, 3)
+    triangles = numpy.asarray(pinocchioMesh.triangles, dtype=numpy.int64).reshape(-1, 3)
+    numTarget = max(4, int(len(points) * ratio))
+    
+    # Start with the cell size that would give numTarget cells covering the
+    # surface, then adjust it to suit the mesh
+    triPoints = points[triangles]
+    area = numpy.sqrt((numpy.cross(triPoints[:, 1] - triPoints[:, 0],
+                                   triPoints[:, 2] - triPoints[:, 0]) ** 2
+                       ).sum(axis=1)).sum() / 2
+    del triPoints
+    cellSize = max(numpy.sqrt(area / numTarget), 1e-12)
+    minPoint = points.min(axis=0)
+    best = None
+    for i in xrange(_PROXY_ITERATIONS):
+        cells = numpy.floor((points - minPoint) / cellSize).astype(numpy.int64)
+        numCells = cells.max(axis=0) + 1
+        keys = (cells[:, 0] * numCells[1] + cells[:, 1]) * numCells[2] + cells[:, 2]
+        keys, labels = numpy.unique(keys, return_inverse=True)
+        numClusters = len(keys)
+        if best is None or abs(numClusters - numTarget) < abs(best[0] - numTarget):
+            best = (numClusters, labels)
+        if abs(numClusters - numTarget) <= _PROXY_TOLERANCE * numTarget:
+            break
+        # The number of cells a surface covers goes as 1 / cellSize ** 2
+        cellSize *= numpy.sqrt(float(numClusters) / numTarget)
+    numClusters, labels = best
+    counts = numpy.bincount(labels, minlength=numClusters).astype(numpy.float64)
+    proxyPoints = numpy.empty((numClusters, 3))
+    for axis in xrange(3):
+        proxyPoints[:, axis] = numpy.bincount(labels, weights=points[:, axis],
+                                              minlength=numClusters) / counts
+    
+    proxyTriangles = labels[triangles]
+    proxyTriangles = proxyTriangles[(proxyTriangles[:, 0] != proxyTriangles[:, 1]) &
+                                    (proxyTriangles[:, 1] != proxyTriangles[:, 2]) &
+                                    (proxyTriangles[:, 2] != proxyTriangles[:, 0])]
+    # Remove duplicates (in either winding), keeping the first
+    sortedTriangles = numpy.sort(proxyTriangles, axis=1)
+    order = numpy.lexsort(sortedTriangles.T[::-1])
+    sortedTriangles = sortedTriangles[order]
+    firsts = numpy.ones(len(order), dtype=bool)
+    firsts[1:] = (sortedTriangles[1:] != sortedTriangles[:-1]).any(axis=1)
+    proxyTriangles = proxyTriangles[numpy.sort(order[firsts])]
+    # Only keep the first two triangles using each edge
+    edges = numpy.sort(proxyTriangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    edgeKeys = edges[:, 0] * numClusters + edges[:, 1]
+    order = numpy.argsort(edgeKeys, kind='mergesort')
+    sortedKeys = edgeKeys[order]
+    groupStarts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(sortedKeys))[0] + 1))
+    ranks = numpy.arange(len(sortedKeys)) - numpy.repeat(groupStarts,
+                                numpy.diff(numpy.append(groupStarts, len(sortedKeys))))
+    extra = numpy.zeros(len(proxyTriangles), dtype=bool)
+    extra[order[ranks >= 2] // 3] = True
+    proxyTriangles = proxyTriangles[~extra]
+    if not len(proxyTriangles):
+        raise PinocchioError("the proxy mesh has no triangles left - try a "
+                             "higher ratio")
+    
+    # Drop the vertices no longer used by any triangle
+    used = numpy.zeros(numClusters, dtype=bool)
+    used[proxyTriangles.ravel()] = True
+    newIndices = numpy.cumsum(used) - 1
+    newIndices[~used] = -1
+    proxyTriangles = newIndices[proxyTriangles].ravel().tolist()
+    proxyTriangles.extend(closeBorderTriangles(proxyTriangles))
+    proxyMesh = PinocchioMesh(proxyPoints[used].ravel().tolist(), proxyTriangles)
+    return proxyMesh, newIndices[labels]
 
-def readPinocchioWeights(weightFile):
-    weightList = []
-    fileObj = open(weightFile)
-    try:
-        for line in fileObj:
-            weightList.append([float(x) for x in line.strip().split(' ')])
-    finally:
-        fileObj.close()
-    return weightList
+def transferWeights(proxyWeights, proxyMesh, pinocchioMesh, vertexMap=None):
+    """
+    Carries weights solved on a proxy mesh (see makeProxyMesh) back to the
+    vertices of the full mesh: each vertex gets the weights at the closest
+    point on the proxy's surface, interpolated from the weights of that
+    triangle's vertices with barycentric coordinates.
+    
+    The closest triangle is found among the proxy triangles whose centers are
+    nearest the vertex, using a kd-tree.
+    
+    Returns (weights, error), where weights is a SparseWeights with one row for
+    each vertex of the full mesh, and error is a dict describing how far the
+    result may be from a full solve:
+        'maxDistance', 'meanDistance'
+            The max and mean distance from the full mesh's vertices to the
+            proxy's surface
+        'size'
+            The length of the diagonal of the mesh's bounding box, for scale
+        'maxWeightChange', 'meanWeightChange'
+            The max and mean (over the vertices) of the largest difference
+            between the transferred weights of a vertex and the weights of
+            the proxy vertex it was merged into - ie, how much the weights
+            vary over the span of one proxy vertex.  Only given if vertexMap
+            is.
+    """
+    if numpy is None or scipy is None:
+        raise PinocchioError("transferring weights requires numpy and scipy")
+    points = numpy.asarray(pinocchioMesh.points, dtype=numpy.float64).reshape(-1, 3)
+    proxyPoints = numpy.asarray(proxyMesh.points, dtype=numpy.float64).reshape(-1, 3)
+    proxyTriangles = numpy.asarray(proxyMesh.triangles, dtype=numpy.int64).reshape(-1, 3)
+    triPoints = proxyPoints[proxyTriangles]
+    tree = scipy.spatial.cKDTree(triPoints.mean(axis=1))
+    numCandidates = min(_TRANSFER_CANDIDATES, len(proxyTriangles))
+    
+    numVerts = len(points)
+    distances = numpy.empty(numVerts)
+    barycentrics = numpy.empty((numVerts, 3))
+    closestTriangles = numpy.empty(numVerts, dtype=numpy.int64)
+    for start in xrange(0, numVerts, _TRANSFER_BLOCK_SIZE):
+        block = points[start:start + _TRANSFER_BLOCK_SIZE]
+        candidates = tree.query(block, k=numCandidates)[1].reshape(len(block), -1)
+        candidatePoints = triPoints[candidates]
+        blockBarycentrics, distancesSq = _closestPointsOnTriangles(
+            block[:, None, :], candidatePoints[:, :, 0], candidatePoints[:, :, 1],
+            candidatePoints[:, :, 2])
+        best = distancesSq.argmin(axis=1)
+        rows = numpy.arange(len(block))
+        end = start + len(block)
+        distances[start:end] = numpy.sqrt(distancesSq[rows, best])
+        barycentrics[start:end] = blockBarycentrics[rows, best]
+        closestTriangles[start:end] = candidates[rows, best]
+    
+    transfer = scipy.sparse.csr_matrix(
+        (barycentrics.ravel(), proxyTriangles[closestTriangles].ravel(),
+         numpy.arange(0, 3 * numVerts + 1, 3)),
+        shape=(numVerts, len(proxyPoints)))
+    solved = scipy.sparse.csr_matrix(
+        (proxyWeights.values, proxyWeights.indices, proxyWeights.offsets),
+        shape=(len(proxyWeights), proxyWeights.numColumns))
+    weights = _normalizedRows(transfer * solved)
+    
+    error = {'maxDistance': float(distances.max()),
+             'meanDistance': float(distances.mean()),
+             'size': float(numpy.sqrt(((points.max(axis=0) -
+                                        points.min(axis=0)) ** 2).sum()))}
+    if vertexMap is not None:
+        merged = vertexMap >= 0
+        nearest = scipy.sparse.csr_matrix(
+            (numpy.ones(merged.sum()), vertexMap[merged], numpy.concatenate(
+                ([0], numpy.cumsum(merged)))),
+            shape=(numVerts, len(proxyPoints)))
+        changes = abs(weights - nearest * solved).max(axis=1).toarray().ravel()
+        error['maxWeightChange'] = float(changes.max())
+        error['meanWeightChange'] = float(changes.mean())
+    return SparseWeights(weights.indptr.astype(numpy.int64),
+                         weights.indices.astype(numpy.int32),
+                         weights.data, weights.shape[1]), error
 
-def runPinocchioBin(meshFile, weightFile, fit=False, stiffness=1.0, skelOut="skeleton.out",
-                    weightOut="weights.out"):
-    # Change current directory to ensure we know where attachment.out will be
-    if not os.path.isfile(_PINOCCHIO_BIN):
-        raise BinaryNotFoundError("Could not find the binary: %s" %
-                                  _PINOCCHIO_BIN)
-    os.chdir(_PINOCCHIO_DIR)
-    exeAndArgs = [_PINOCCHIO_BIN, meshFile, '-skel', weightFile,
-                  '-stiffness', str(stiffness),
-                  '-skelOut', skelOut,
-                  '-weightOut', weightOut]
-    if fit:
-        exeAndArgs.append('-fit')
-    if DEBUG:
-        print "Calling command line binary:"
-        print 'subprocess.call(%r)' % exeAndArgs
-        print ' '.join(exeAndArgs)
-    returnVal = subprocess.call(exeAndArgs)
-    if returnVal != 0:
-        raise PinocchioError("return code: %d" % returnVal)
+def _normalizedRows(weights):
+    """
+    Returns the csr matrix of weights, with any at or below WEIGHT_EPSILON
+    dropped, and each row scaled to sum to 1
+    """
+    weights = weights.tocsr()
+    weights.data[weights.data <= WEIGHT_EPSILON] = 0.
+    weights.eliminate_zeros()
+    sums = numpy.asarray(weights.sum(axis=1)).ravel()
+    sums[sums == 0] = 1.
+    weights.data /= numpy.repeat(sums, numpy.diff(weights.indptr))
+    weights.sort_indices()
+    return weights
 
-def heatWeight(*args, **kwargs):
+def _closestPointsOnTriangles(points, a, b, c):
     """
-    heatWeight(*rootAndMeshes, **kwargs)
+    Returns (barycentrics, distancesSq) for the closest point to each point on
+    the triangle with corners a, b, c (which may be any broadcastable arrays
+    of 3d vectors), following Ericson's Real-Time Collision Detection: the
+    (... x 3) barycentric coordinates of the closest point, and its squared
+    distance from the point.
+    """
+    def dot(x, y):
+        return (x * y).sum(axis=-1)
+    def ratio(numerator, denominator):
+        return numerator / numpy.where(denominator == 0, 1., denominator)
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    bp = points - b
+    cp = points - c
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
     
-    The non-keyword args should consist of exactly one skeleton root, and
-    at least one mesh you wish to weight to that skeleton. If no args are
-    given, the current selection is used.
+    # Each region's test takes priority over those after it, so go backwards
+    # from the inside of the triangle
+    denominator = ratio(1., va + vb + vc)
+    v = vb * denominator
+    w = vc * denominator
+    u = 1. - v - w
+    regions = [
+        # Vertex a
+        ((d1 <= 0) & (d2 <= 0), 1., 0., 0.),
+        # Vertex b
+        ((d3 >= 0) & (d4 <= d3), 0., 1., 0.),
+        # Edge ab
+        ((vc <= 0) & (d1 >= 0) & (d3 <= 0),
+         1. - ratio(d1, d1 - d3), ratio(d1, d1 - d3), 0.),
+        # Vertex c
+        ((d6 >= 0) & (d5 <= d6), 0., 0., 1.),
+        # Edge ac
+        ((vb <= 0) & (d2 >= 0) & (d6 <= 0),
+         1. - ratio(d2, d2 - d6), 0., ratio(d2, d2 - d6)),
+        # Edge bc
+        ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0),
+         0., 1. - ratio(d4 - d3, (d4 - d3) + (d5 - d6)),
+         ratio(d4 - d3, (d4 - d3) + (d5 - d6))),
+    ]
+    for inRegion, regionU, regionV, regionW in reversed(regions):
+        u = numpy.where(inRegion, regionU, u)
+        v = numpy.where(inRegion, regionV, v)
+        w = numpy.where(inRegion, regionW, w)
+    closest = u[..., None] * a + v[..., None] * b + w[..., None] * c
+    return (numpy.concatenate((u[..., None], v[..., None], w[..., None]), axis=-1),
+            ((points - closest) ** 2).sum(axis=-1))
+
+#==============================================================================
+# Weight Cache
+#==============================================================================
+
+class WeightCache(object):
+    """
+    A directory of Pinocchio weight results, keyed on a hash of everything
+    that goes into a solve (see makeKey), so that solving an unchanged mesh
+    again can be skipped.
     
-    Valid keyword args:
-    undoable=False
-        Specify whether to assign skin weights using a slower, but undoable
-        method, or a faster method that requires flushing the undo queue.
-    stiffness=1.0
-        Specify how 'stiff' to make the binding to the skeleton. The higher
-        the value, the more tightly vertices will be bound to the joint
-        deemed 'closest', and the less weights will 'bleed'.
-        Note that if a joint is relatively 'far' from all bones, then modifying
-        this value still may not have much effect, as (in essence) the computer
-        is unsure WHICH bone the joint should be more stiffly bound to. This
-        situation can result when, for instance, you have a very round, fat
-        character.  In this case, the best idea is to either add bones which
-        are 'closer' to the problem area, or simply correct it with weight
-        painting afterward.  (This script is not meant to replace weight
-        painting, but merely to give you a better place to start from!)
-    tempOutputDir=None
-        Specify a directory where temporary files used by the Pinocchio binary
-        are stored
-    tempDelete=True
-        Whether or not to delete the temporary files used by the Pinocchio binary
-        when finished
-    tempOverwrite=True
-        Whether or not to overwrite any existing temporary files
-    directDescendentsOnly=False
-        heatWeight only weights joints; this controls whether there must be a
-        direct joint chain from the root to joints included in the skeleton, or
-        whether there can be intervening (non-joint) transforms.
-        ie, if this setting is False, a joint such as
-            myRoot|myTransform|otherJoint
-        would NOT be allowed; if it is True, it would be.
+    Entries are stored as serialized SparseWeights; when the directory grows
+    beyond maxSize bytes, the least recently used entries are removed.  Since
+    entries are written atomically, and never modified, the directory may be
+    shared between several users / machines.
     """
-    if not args:
-        args = listForNone(cmds.ls(sl=1))
+    SUFFIX = '.weights'
     
-    fit = kwargs.pop('fit', False)
-    stiffness = kwargs.pop('stiffness', 1.0)
-    tempOutputDir = kwargs.pop('tempOutputDir', None)
-    tempDelete = kwargs.pop('tempDelete', True)
-    tempOverwrite = kwargs.pop('tempOverwrite', True)
-    directDescendentsOnly = kwargs.pop('directDescendentsOnly', False)
+    def __init__(self, cacheDir, maxSize=None):
+        if maxSize is None:
+            maxSize = int(os.environ.get(_CACHE_SIZE_ENV,
+                                         _DEFAULT_CACHE_SIZE_MB)) << 20
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                # Someone else may have made it in the meantime
+                if not os.path.isdir(cacheDir):
+                    raise
     
-    if tempOutputDir:
-        outputDir = tempOutputDir
-    else:
-        outputDir = tempfile.mkdtemp()
+    @staticmethod
+    def makeKey(objDigest, skelText, stiffness, fit, binaryDigest):
+        """
+        Returns the cache key for solving a mesh, given the digest of its obj
+        file contents, the contents of the skeleton file, the solve
+        parameters, and a digest of the binary used.
+        """
+        digest = hashlib.sha1()
+        for item in (objDigest, skelText, repr(float(stiffness)), repr(bool(fit)),
+                     binaryDigest):
+            digest.update(item)
+            digest.update('\0')
+        return digest.hexdigest()
     
-    inputArgsMessage = "Select one root joint and meshes you wish to weight"
-    meshes = []
-    rootJoint = None
-    for arg in args:
-        if isATypeOf(arg, 'joint'):
-            if rootJoint is None:
-                rootJoint = arg
-            else:
-                api.MGlobal.displayError("multiple joints - " +
-                                         inputArgsMessage)
-                return False
-        elif isATypeOf(arg, 'mesh'):
-            meshes.append(arg)
-        elif isATypeOf(arg, 'transform'):
-            shapes = [x for x in getShapes(arg) if isATypeOf(x, 'mesh')]
-            if len(shapes) == 0: 
-                api.MGlobal.displayWarning(
-                    "transform has no poly shape: %s" % arg)
-            else:
-                meshes.extend(shapes) 
-        else:
-            api.MGlobal.displayError(
-                ("not a poly mesh, transform, or joint: %s - " % arg) +
-                inputArgsMessage)
-            return False
-    if rootJoint is None:
-        api.MGlobal.displayError("no root joint - "  + inputArgsMessage)
-        return False
-    if not meshes:
-        api.MGlobal.displayError("no meshes - "  + inputArgsMessage)
-        return False
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + self.SUFFIX)
     
-    if 'undoable' in kwargs:
-        undoable = kwargs['undoable']
-    else:
-        undoable = useUndoableMethod()
+    def get(self, key):
+        """
+        Returns the SparseWeights stored for the given key, or None
+        """
+        path = self._path(key)
+        try:
+            fileObj = open(path, 'rb')
+            try:
+                data = fileObj.read()
+            finally:
+                fileObj.close()
+            weights = SparseWeights.deserialize(data)
+        except (IOError, OSError, zlib.error, struct.error, PinocchioError):
+            return None
+        # Mark it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return weights
     
-    for meshNum, mesh in enumerate(meshes):
+    def put(self, key, weights):
+        """
+        Stores the SparseWeights for the given key, then evicts the least
+        recently used entries if the cache is too big.
+        """
+        fd, tempPath = tempfile.mkstemp(suffix='.tmp', dir=self.cacheDir)
         try:
-            skinClusters = getSkinClusters(mesh)
-            if skinClusters:
-                skin = skinClusters[0]
-            else:
-                skin = cmds.skinCluster(mesh, rootJoint, rui=False)[0]
-            
-            tempArgs={}
-            
-            def makeFilename(prefix, suffix):
-                # We include the meshNum in the name to ensure that each filename is unique;
-                # we cannot simply use mesh.name(), which would return a unique name, as it might
-                # include characters - such as '|' - that windows won't allow as a filename
-                newName = os.path.join(outputDir, '%s%d_%s%s' % (prefix, meshNum, leafName(mesh), suffix))
-                if (not tempOverwrite) and os.path.exists(newName):
-                    raise CannotOverwriteError("file %r already exists" % newName)
-                return newName
-                
-            
-            objFilePath = makeFilename('model', '.obj')
-            skelFilePath = makeFilename('skel', '.skel')
-            outSkelPath = makeFilename('outSkel', '.skel')
-            outWeightPath = makeFilename('weight', '.weight')
-            
-            tempFiles = (objFilePath, skelFilePath, outSkelPath, outWeightPath)
+            fileObj = os.fdopen(fd, 'wb')
             try:
-                    skelFilePath, skelList = \
-                        pinocchioSkeletonExport(rootJoint, skelFilePath,
-                                                directDescendentsOnly=directDescendentsOnly)
-                    objFilePath = pinocchioObjExport(mesh, objFilePath)
-                    
-                    runPinocchioBin(objFilePath, skelFilePath,
-                                    fit=fit, stiffness=stiffness,
-                                    skelOut=outSkelPath, weightOut=outWeightPath)
-                    pinocchioWeightsImport(mesh, skin, skelList,
-                                           weightFile=outWeightPath, undoable=undoable)
+                fileObj.write(weights.serialize())
             finally:
-                if tempDelete:
-                    for tempFile in tempFiles:
-                        if os.path.isfile(tempFile):
-                            os.remove(tempFile)
-        except Exception, e:
-            if DEBUG:
-                exceptionInfo = traceback.format_exc()
-            else:
-                exceptionInfo = str(e)
-            api.MGlobal.displayWarning(
-                    "encountered exception while weighting mesh %s:\n%s" % (mesh, exceptionInfo))
-    if tempDelete and not os.listdir(outputDir):
-        os.rmdir(outputDir)
-    return True
+                fileObj.close()
+            try:
+                os.rename(tempPath, self._path(key))
+            except OSError:
+                # On windows, rename fails if another process already stored
+                # this key - which is fine, as its contents are the same
+                pass
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        self.evict()
+    
+    def evict(self):
+        """
+        Removes the least recently used entries, until the cache is no bigger
+        than maxSize.
+        """
+        entries = []
+        totalSize = 0
+        for fileName in os.listdir(self.cacheDir):
+            if not fileName.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.cacheDir, fileName)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            totalSize += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # May have already been evicted by someone else
+                pass
+            totalSize -= size
+
+_CACHE_DIR_ENV = 'PM_HEATWEIGHT_CACHE_DIR'
+_CACHE_SIZE_ENV = 'PM_HEATWEIGHT_CACHE_SIZE'
+_DEFAULT_CACHE_SIZE_MB = 1024
+
+def fileDigest(path):
+    """
+    Returns a hash of the contents of the given file
+    """
+    digest = hashlib.sha1()
+    fileObj = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: fileObj.read(_WRITE_BUFFER_SIZE), ''):
+            digest.update(chunk)
+    finally:
+        fileObj.close()
+    return digest.hexdigest()
+
+# (path, size, mtime) -> digest, so the binary is only hashed once
+_binaryDigests = {}
+
+def binaryDigest(binary=None):
+    """
+    Returns a hash identifying the version of the Pinocchio binary
+    """
+    if binary is None:
+        binary = _PINOCCHIO_BIN
+    stat = os.stat(binary)
+    statKey = (binary, stat.st_size, stat.st_mtime)
+    if statKey not in _binaryDigests:
+        _binaryDigests[statKey] = fileDigest(binary)
+    return _binaryDigests[statKey]
 
 # This doesn't work - apparently demoui can't take animation data for arbitrary
 # skeletons - it requires exactly 114 entries per line??? 
@@ -721,6 +3739,182 @@ def getNodeIndex(node, nodeList):
 
 def isSameObject(node1, node2):
     return mel.eval('isSameObject("%s", "%s")' % (node1, node2))
+
+def dagPathKey(node):
+    """
+    Returns the full dag path of the given node, so that two names for the
+    same dag node give the same key (ie, it may be used in place of
+    isSameObject, for dict lookups).
+    """
+    dagPath = toMDagPath(node)
+    if dagPath is None:
+        return node
+    return dagPath.fullPathName()
+#==============================================================================
+# Batch
+#==============================================================================
+
+def batchWeight(manifest, workers=1, outputDir=None, summaryFile=None):
+    """
+    Weights the meshes of many scenes, listed in a manifest, without the ui:
+    each scene is opened in one of a pool of maya.standalone worker
+    processes (each initialized once, then reused for many scenes), weighted
+    with heatWeight, and saved.
+    
+    manifest is either the path of a json file, or the equivalent object - a
+    dict, with an 'assets' list (and optionally an 'options' dict), or just
+    the list of assets.  Each asset is a dict with:
+        scene
+            The scene file to open
+        root
+            The root joint of the skeleton
+        meshes
+            A list of the meshes (or transforms, or components) to weight
+        output (optional)
+            Where to save the weighted scene; defaults to the scene's file
+            name in outputDir. The file type is chosen from its extension.
+        name (optional)
+            Identifies the asset in the summary; defaults to the scene's
+            file name
+        options (optional)
+            Keyword args for heatWeight, overriding those in the manifest's
+            top-level options
+    Relative paths are relative to the manifest file's directory (or the
+    current directory, if given an object).  undoable is always False.
+    
+    Returns the summary: a dict with the number of assets which succeeded and
+    failed, the total time taken, and for each asset (in manifest order) its
+    status ('succeeded', or 'failed' if there were any errors), the time
+    taken by each stage, and the error of each mesh which failed, or of the
+    asset as a whole.  If summaryFile is given, the summary is also written
+    to it, as json.
+    """
+    if isinstance(manifest, basestring):
+        baseDir = os.path.dirname(os.path.abspath(manifest))
+        manifestFile = open(manifest)
+        try:
+            manifest = json.load(manifestFile)
+        finally:
+            manifestFile.close()
+    else:
+        baseDir = os.getcwd()
+    if isinstance(manifest, dict):
+        assets = manifest.get('assets', [])
+        options = manifest.get('options', {})
+    else:
+        assets = manifest
+        options = {}
+    
+    tasks = []
+    for index, asset in enumerate(assets):
+        task = dict(asset)
+        task['index'] = index
+        task['options'] = dict(options)
+        task['options'].update(asset.get('options', {}))
+        scene = asset.get('scene')
+        if scene:
+            task['scene'] = os.path.join(baseDir, scene)
+            task.setdefault('name', os.path.basename(scene))
+            if asset.get('output'):
+                task['output'] = os.path.join(baseDir, asset['output'])
+            elif outputDir:
+                task['output'] = os.path.join(baseDir, outputDir,
+                                              os.path.basename(scene))
+        tasks.append(task)
+    
+    startTime = time.time()
+    results = [None] * len(tasks)
+    if tasks:
+        pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(),
+                                        len(tasks)),
+                                    initializer=_initBatchWorker)
+        try:
+            for result in pool.imap_unordered(_batchWeightAsset, tasks):
+                results[result['index']] = result
+                print "%s: %s (%.1fs)" % (result['name'], result['status'],
+                                          result['seconds']['total'])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+    
+    summary = {
+        'version': str(version),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                 time.localtime(startTime)),
+        'seconds': time.time() - startTime,
+        'succeeded': len([x for x in results if x['status'] == 'succeeded']),
+        'failed': len([x for x in results if x['status'] != 'succeeded']),
+        'assets': results,
+    }
+    if summaryFile:
+        fileObj = open(summaryFile, 'w')
+        try:
+            json.dump(summary, fileObj, indent=2, sort_keys=True)
+        finally:
+            fileObj.close()
+    return summary
+
+def _initBatchWorker():
+    import maya.standalone
+    maya.standalone.initialize(name='python')
+
+def _batchWeightAsset(task):
+    """
+    Opens, weights and saves a single batchWeight asset, in a worker process;
+    returns its result, for the summary.  Never raises.
+    """
+    result = {'index': task['index'],
+              'name': task.get('name', 'asset %d' % task['index']),
+              'scene': task.get('scene'),
+              'output': task.get('output'),
+              'status': 'failed',
+              'error': None,
+              'meshes': [],
+              'seconds': {}}
+    seconds = result['seconds']
+    startTime = lastTime = time.time()
+    def stageDone(stage):
+        now = time.time()
+        seconds[stage] = now - lastTime
+        return now
+    try:
+        for key in ('scene', 'root', 'meshes', 'output'):
+            if not task.get(key):
+                raise PinocchioError("asset has no %r" % key)
+        
+        cmds.file(new=True, force=True)
+        cmds.file(task['scene'], open=True, force=True, prompt=False)
+        lastTime = stageDone('load')
+        
+        kwargs = dict(task['options'])
+        kwargs['undoable'] = False
+        jobs = _heatWeightJobs([task['root']] + list(task['meshes']), kwargs)
+        lastTime = stageDone('weight')
+        if jobs is None:
+            raise PinocchioError("invalid root joint or meshes")
+        for job in jobs:
+            result['meshes'].append({'mesh': job.mesh, 'error': job.error})
+        
+        outputDir = os.path.dirname(task['output'])
+        if outputDir and not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        if os.path.splitext(task['output'])[1].lower() == '.ma':
+            fileType = 'mayaAscii'
+        else:
+            fileType = 'mayaBinary'
+        cmds.file(rename=task['output'])
+        cmds.file(save=True, force=True, type=fileType)
+        lastTime = stageDone('save')
+        
+        if all(job.error is None for job in jobs):
+            result['status'] = 'succeeded'
+    except Exception, e:
+        result['error'] = _formatException(e)
+    seconds['total'] = time.time() - startTime
+    return result
+
 #==============================================================================
 # Pymel Replacements
 #==============================================================================
@@ -845,6 +4039,19 @@ def influenceObjects(skinCluster):
         influences.append(dagPaths[i].fullPathName())
     return influences
 
+def influenceLogicalIndices(skinCluster):
+    """
+    Returns the logical index (ie, the index used by the weightList.weights
+    and matrix plugs) of each influence returned by influenceObjects
+    """
+    mfnSkin = apiAnim.MFnSkinCluster(toMObject(skinCluster))
+    dagPaths = api.MDagPathArray()
+    mfnSkin.influenceObjects(dagPaths)
+    logicalIndices = []
+    for i in xrange(dagPaths.length()):
+        logicalIndices.append(mfnSkin.indexForInfluenceObject(dagPaths[i]))
+    return logicalIndices
+
 def isValidMObject (obj):
     if isinstance(obj, api.MObject) :
         return not obj.isNull()
@@ -921,3 +4128,51 @@ def leafName(node):
 
     Note that shortNameOf is NOT guaranteed to give this...'''
     return node.split("|")[-1]
+
+#==============================================================================
+# Command Line
+#==============================================================================
+
+_USAGE = """%prog batch MANIFEST [options]
+
+Weights the meshes of each scene listed in the json MANIFEST, in a pool of
+maya.standalone processes; see batchWeight for the manifest's format."""
+
+def main(argv=None):
+    """
+    The command line entry point, run by 'mayapy -m PM_heatWeight'.
+    
+    Returns the exit status: 0 if everything succeeded, 1 if any asset
+    failed, or 2 if the command line was invalid.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = optparse.OptionParser(usage=_USAGE)
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help="number of maya processes to run at once; 0 for one "
+                           "per cpu [default: %default]")
+    parser.add_option('-o', '--output-dir', dest='outputDir',
+                      help="directory to save weighted scenes to, for assets "
+                           "without an output")
+    parser.add_option('-s', '--summary', dest='summaryFile',
+                      help="file to write the json summary of the results to")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] != 'batch':
+        parser.print_usage(sys.stderr)
+        return 2
+    summary = batchWeight(args[1], workers=options.workers,
+                          outputDir=options.outputDir,
+                          summaryFile=options.summaryFile)
+    print "%d assets succeeded, %d failed, in %.1fs" % (summary['succeeded'],
+                                                         summary['failed'],
+                                                         summary['seconds'])
+    if summary['failed']:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    # Run in the importable module, rather than __main__, so there is only
+    # one copy of the module's state - the plugin and worker processes use
+    # the importable one
+    import PM_heatWeight
+    sys.exit(PM_heatWeight.main())
@@ -0,0 +1,97 @@
+#==============================================================================
+#Copyright (c) 2009 Paul Molodowitch
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+#
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+#==============================================================================
+
+'''
+Maya plugin for PM_heatWeight, providing the pmHeatWeightSetWeights command.
+
+The command sets the weights computed by PM_heatWeight.pinocchioWeightsImport
+using the api, which is much faster than skinPercent, while saving the old
+weights so that it can be undone.  It is not meant to be called directly - it
+is loaded and invoked by PM_heatWeight when setting weights undoably.
+'''
+
+import maya.OpenMaya as api
+import maya.OpenMayaMPx as apiMPx
+
+import PM_heatWeight
+
+COMMAND_NAME = 'pmHeatWeightSetWeights'
+
+class SetWeightsCmd(apiMPx.MPxCommand):
+    """
+    pmHeatWeightSetWeights(key)
+    
+    Sets the weights stored by PM_heatWeight under the given key, replacing
+    the weights of every influence of the skin - for all the mesh's vertices,
+    or just those stored with the weights.
+    """
+    def __init__(self):
+        apiMPx.MPxCommand.__init__(self)
+        self.skin = None
+        self.mesh = None
+        self.newWeights = None
+        self.oldWeights = None
+        self.vertices = None
+    
+    def doIt(self, args):
+        key = args.asString(0)
+        self.skin, self.mesh, self.newWeights, self.vertices = \
+            PM_heatWeight._popPendingWeights(key)
+        self.oldWeights = PM_heatWeight._getSparseSkinWeights(
+            self.skin, self.mesh, len(self.newWeights), vertices=self.vertices)
+        self.redoIt()
+    
+    def redoIt(self):
+        try:
+            self._setWeights(self.newWeights)
+        except Exception:
+            # There was a problem, restore the saved weights!
+            self._setWeights(self.oldWeights)
+            api.MGlobal.displayError("Encountered error setting new weights - original weights restored")
+            raise
+    
+    def undoIt(self):
+        self._setWeights(self.oldWeights)
+    
+    def isUndoable(self):
+        return True
+    
+    def _setWeights(self, weights):
+        PM_heatWeight._setSparseSkinWeights(self.skin, self.mesh, weights,
+                                            range(weights.numColumns),
+                                            allColumns=True,
+                                            vertices=self.vertices)
+
+def cmdCreator():
+    return apiMPx.asMPxPtr(SetWeightsCmd())
+
+def initializePlugin(mobject):
+    mplugin = apiMPx.MFnPlugin(mobject, 'Paul Molodowitch',
+                               str(PM_heatWeight.version))
+    mplugin.registerCommand(COMMAND_NAME, cmdCreator)
+
+def uninitializePlugin(mobject):
+    mplugin = apiMPx.MFnPlugin(mobject)
+    mplugin.deregisterCommand(COMMAND_NAME)